@@ -1026,7 +1026,15 @@ function bindEvents() {
 
   els.importLeadsBtn?.addEventListener("click", async () => {
     try {
-      const res = await api("/api/leads/import-now", { method: "POST" });
+      const job = await api("/api/leads/import-now", { method: "POST" });
+      let res = job;
+      while (res.status === "queued" || res.status === "running") {
+        await new Promise((resolve) => window.setTimeout(resolve, 500));
+        res = await api(`/api/leads/import-status?job_id=${encodeURIComponent(job.job_id)}`);
+      }
+      if (res.status === "error") {
+        throw new Error(res.error || "Lead import failed");
+      }
       showToast(`Leads sync: +${res.result.imported} new, ${res.result.updated} updated`, "ok");
       refreshAll();
     } catch (err) {
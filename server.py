@@ -1,34 +1,104 @@
 #!/usr/bin/env python3
+import base64
 import csv
 import hashlib
+import hmac
 import io
 import json
 import math
 import os
-import random
 import re
 import secrets
+import signal
 import sqlite3
+import stat
+import string
 import threading
 import time
-import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
 from difflib import SequenceMatcher
+from functools import lru_cache
 from http import HTTPStatus
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
-from urllib.parse import parse_qs, unquote, urlparse
+from typing import Callable, Iterable, Iterator, TextIO
+from urllib.parse import unquote, unquote_plus, urlparse
 
 BASE_DIR = Path(__file__).resolve().parent
 DATA_DIR = Path(os.getenv("DATA_DIR", str(BASE_DIR / "data")))
 STATIC_DIR = BASE_DIR / "static"
 DB_PATH = DATA_DIR / "app.db"
 LEADS_IMPORT_FILE = DATA_DIR / "leads_import.csv"
+PHOTOS_DIR = DATA_DIR / "photos"
+MAX_REQUEST_BODY_BYTES = 2 * 1024 * 1024
 LEAD_SYNC_INTERVAL_SECONDS = 30 * 60
+MAINTENANCE_INTERVAL_SECONDS = 30
+LEAD_IMPORT_BATCH_SIZE = 1000
+LEAD_IMPORT_JOBS_MAX = 100
 MAX_OTP_ATTEMPTS = 3
 OTP_TTL_SECONDS = 120
 GEO_RADIUS_METERS = 200
+EARTH_DIAMETER_METERS = 2 * 6371000
 SESSION_HOURS = 24
+PASSWORD_SCRYPT_N = 2**14
+PASSWORD_SCRYPT_R = 8
+PASSWORD_SCRYPT_P = 1
+PASSWORD_SALT_BYTES = 16
+AUTH_CACHE_TTL_SECONDS = 60
+AUTH_CACHE_MAX_ENTRIES = 10000
+STATIC_CACHE_MAX_BYTES = 64 * 1024
+JSON_STREAM_CHUNK_BYTES = 64 * 1024
+HTTP_KEEPALIVE_TIMEOUT_SECONDS = 5
+HTTP_LISTEN_BACKLOG = 1024
+STARTUP_BANNER = "\n".join(
+    (
+        "Proptech MVP running",
+        "URL: http://{ui_host}:{port}",
+        "Listening on {host}:{port}",
+        "Demo users:",
+        "- broker.jaipur@example.com / broker123",
+        "- broker.nagpur@example.com / broker123",
+        "- rm.jaipur@example.com / rm123",
+        "- rm.nagpur@example.com / rm123",
+        "- srm.ops@example.com / srm123",
+    )
+)
+DASHBOARD_CACHE_TTL_SECONDS = 15
+ASSIGNED_BROKERS_CACHE_TTL_SECONDS = 60
+DB_POOL_MAX_IDLE = 8
+DB_WRITER_CONNECTIONS = 1
+DB_BUSY_TIMEOUT_SECONDS = 30
+DB_CACHED_STATEMENTS = 256
+INVENTORY_LIST_COLUMNS = (
+    "id, broker_id, title, asset_type, configuration, bhk, location_text, city, price, "
+    "status, hidden_from_customers, duplicate_score, primary_property_id, created_at, updated_at"
+)
+VISIT_COLUMNS = (
+    "v.id, v.slot_id, v.property_id, v.broker_id, v.rm_id, v.customer_id, v.customer_requirements, "
+    "v.start_at, v.end_at, v.start_ts, v.status, v.cancelled_by, v.cancellation_reason, v.priority_rebook_until, "
+    "v.otp_code, v.otp_expires_at, v.otp_attempts, v.otp_sent_at, v.checkin_lat, v.checkin_lng, "
+    "v.distance_meters, v.photo_fallback_sha256, v.is_unique_visit, v.completion_mode, v.completed_at, "
+    "v.created_at, v.updated_at"
+)
+INVENTORY_FIELDS = (
+    ("title", None, True),
+    ("asset_type", None, True),
+    ("configuration", None, False),
+    ("spec_value", float, False),
+    ("spec_unit", None, False),
+    ("bhk", None, False),
+    ("area_value", float, False),
+    ("location_text", None, True),
+    ("city", None, True),
+    ("price", float, True),
+    ("maps_url", None, False),
+    ("latitude", float, False),
+    ("longitude", float, False),
+    ("amenities", None, False),
+    ("image_url", None, False),
+)
 
 ROLE_BROKER = "BROKER"
 ROLE_RM = "RM"
@@ -63,9 +133,27 @@ INCIDENT_REJECTED_SRM = "rejected_by_srm"
 FLAG_ACTIVE = "active"
 FLAG_DECAYED = "decayed"
 
+EPOCH = datetime(1970, 1, 1)
+DAY_SECONDS = 24 * 60 * 60
+
+SLA_WINDOW_BY_HOUR = tuple(timedelta(hours=12 if hour < 12 else 24) for hour in range(24))
+
 WHATSAPP_LANG = "en"
 WHATSAPP_PROVIDER = "mock_whatsapp_provider"
 
+EMPTY_PAYLOAD_JSON = "{}"
+PAYLOAD_JSON_ENCODER = json.JSONEncoder(separators=(",", ":"))
+EMPTY_ITEMS_JSON_BODY = b'{"ok":true,"items":[]}'
+UNAUTHORIZED_JSON_BODY = b'{"ok":false,"error":"Unauthorized"}'
+FORBIDDEN_JSON_BODY = b'{"ok":false,"error":"Forbidden"}'
+ROUTE_NOT_FOUND_JSON_BODY = b'{"ok":false,"error":"Route not found"}'
+
+NON_DIGIT_RE = re.compile(r"\D")
+WHITESPACE_RE = re.compile(r"\s+")
+HELP_COMMAND_RE = re.compile(r"^HELP$")
+CANCEL_COMMAND_RE = re.compile(r"^CANCEL\s+(\d+)$")
+RESCHEDULE_COMMAND_RE = re.compile(r"^RESCHEDULE\s+(\d+)\s+(\d+)$")
+
 
 def now_local() -> datetime:
     return datetime.now()
@@ -77,19 +165,61 @@ def to_iso(ts: datetime | None) -> str | None:
     return ts.replace(microsecond=0).isoformat()
 
 
+def to_epoch_seconds(ts: datetime) -> int:
+    return int((ts - EPOCH).total_seconds())
+
+
 def parse_iso(value: str | None) -> datetime | None:
     if not value:
         return None
     return datetime.fromisoformat(value)
 
 
+def dump_payload_json(payload: dict | None) -> str:
+    if not payload:
+        return EMPTY_PAYLOAD_JSON
+    return PAYLOAD_JSON_ENCODER.encode(payload)
+
+
 def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode("utf-8")).hexdigest()
+    salt = secrets.token_bytes(PASSWORD_SALT_BYTES)
+    digest = hashlib.scrypt(
+        password.encode("utf-8"),
+        salt=salt,
+        n=PASSWORD_SCRYPT_N,
+        r=PASSWORD_SCRYPT_R,
+        p=PASSWORD_SCRYPT_P,
+    )
+    return f"scrypt${PASSWORD_SCRYPT_N}${PASSWORD_SCRYPT_R}${PASSWORD_SCRYPT_P}${salt.hex()}${digest.hex()}"
+
+
+def verify_password(password: str, stored_hash: str) -> bool:
+    if not stored_hash.startswith("scrypt$"):
+        candidate = hashlib.sha256(password.encode("utf-8")).hexdigest()
+        return hmac.compare_digest(candidate, stored_hash)
+    _, n, r, p, salt_hex, digest_hex = stored_hash.split("$")
+    candidate = hashlib.scrypt(
+        password.encode("utf-8"),
+        salt=bytes.fromhex(salt_hex),
+        n=int(n),
+        r=int(r),
+        p=int(p),
+    ).hex()
+    return hmac.compare_digest(candidate, digest_hex)
+
+
+def password_needs_rehash(stored_hash: str) -> bool:
+    return not stored_hash.startswith(f"scrypt${PASSWORD_SCRYPT_N}${PASSWORD_SCRYPT_R}${PASSWORD_SCRYPT_P}$")
+
+
+DUMMY_PASSWORD_HASH = hash_password("x" * 16)
 
 
 def normalize_phone(phone: str | None) -> str:
     raw = (phone or "").strip()
-    digits = re.sub(r"\D", "", raw)
+    if raw[:1] == "+" and len(raw) != 11 and raw[1:].isascii() and raw[1:].isdigit():
+        return raw
+    digits = NON_DIGIT_RE.sub("", raw)
     if not digits:
         return ""
     if len(digits) == 10:
@@ -101,43 +231,185 @@ def normalize_phone(phone: str | None) -> str:
     return f"+{digits}"
 
 
+@lru_cache(maxsize=8192)
 def normalize_text(value: str | None) -> str:
     text = (value or "").strip().lower()
-    text = re.sub(r"\s+", " ", text)
+    text = WHITESPACE_RE.sub(" ", text)
     return text
 
 
-def text_similarity(a: str | None, b: str | None) -> float:
-    aa = normalize_text(a)
-    bb = normalize_text(b)
+def normalized_similarity(aa: str, bb: str) -> float:
     if not aa or not bb:
         return 0.0
     if aa == bb:
         return 1.0
-    return SequenceMatcher(None, aa, bb).ratio()
+    return _sequence_ratio(aa, bb)
+
+
+@lru_cache(maxsize=4096)
+def _sequence_ratio(a: str, b: str) -> float:
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def haversine_meters(
+    lat1: float,
+    lon1: float,
+    lat2: float,
+    lon2: float,
+    _sin=math.sin,
+    _cos=math.cos,
+    _asin=math.asin,
+    _sqrt=math.sqrt,
+    _rad=math.radians,
+) -> float:
+    s1 = _sin(_rad(lat2 - lat1) * 0.5)
+    s2 = _sin(_rad(lon2 - lon1) * 0.5)
+    a = s1 * s1 + _cos(_rad(lat1)) * _cos(_rad(lat2)) * s2 * s2
+    return EARTH_DIAMETER_METERS * _asin(_sqrt(a))
+
+
+def haversine_meters_batch(lat1: float, lon1: float, points: list[tuple[float | None, float | None]]) -> list[float | None]:
+    sin, cos, asin, sqrt, rad = math.sin, math.cos, math.asin, math.sqrt, math.radians
+    p1 = rad(lat1)
+    cos_p1 = cos(p1)
+    distances: list[float | None] = []
+    for lat2, lon2 in points:
+        if lat2 is None or lon2 is None:
+            distances.append(None)
+            continue
+        p2 = rad(lat2)
+        s1 = sin((p2 - p1) * 0.5)
+        s2 = sin(rad(lon2 - lon1) * 0.5)
+        a = s1 * s1 + cos_p1 * cos(p2) * s2 * s2
+        distances.append(EARTH_DIAMETER_METERS * asin(sqrt(a)))
+    return distances
+
+
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA cache_size=-65536;",
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA mmap_size=268435456;",
+)
+
+class ConnectionPool:
+    def __init__(self, max_idle: int, read_only: bool = False, max_open: int | None = None):
+        self.max_idle = max_idle
+        self.read_only = read_only
+        self._idle: list[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_open) if max_open else None
+
+    def acquire(self) -> sqlite3.Connection:
+        if self._slots is not None and not self._slots.acquire(timeout=DB_BUSY_TIMEOUT_SECONDS):
+            raise sqlite3.OperationalError("database is locked")
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        try:
+            return self._connect()
+        except BaseException:
+            if self._slots is not None:
+                self._slots.release()
+            raise
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.read_only:
+            conn = sqlite3.connect(
+                f"{DB_PATH.resolve().as_uri()}?mode=ro",
+                uri=True,
+                timeout=DB_BUSY_TIMEOUT_SECONDS,
+                check_same_thread=False,
+                cached_statements=DB_CACHED_STATEMENTS,
+            )
+        else:
+            conn = sqlite3.connect(
+                DB_PATH,
+                timeout=DB_BUSY_TIMEOUT_SECONDS,
+                isolation_level="IMMEDIATE",
+                check_same_thread=False,
+                cached_statements=DB_CACHED_STATEMENTS,
+            )
+        conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            keep = len(self._idle) < self.max_idle
+            if keep:
+                self._idle.append(conn)
+        if not keep:
+            conn.close()
+        if self._slots is not None:
+            self._slots.release()
+
+    def prewarm(self) -> None:
+        with self._lock:
+            missing = self.max_idle - len(self._idle)
+        conns = [self._connect() for _ in range(missing)]
+        with self._lock:
+            self._idle.extend(conns)
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+db_pool = ConnectionPool(DB_WRITER_CONNECTIONS, max_open=DB_WRITER_CONNECTIONS)
+db_reader_pool = ConnectionPool(DB_POOL_MAX_IDLE, read_only=True)
+_db_local = threading.local()
 
 
-def haversine_meters(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
-    r = 6371000
-    p1 = math.radians(lat1)
-    p2 = math.radians(lat2)
-    d1 = math.radians(lat2 - lat1)
-    d2 = math.radians(lon2 - lon1)
-    a = math.sin(d1 / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(d2 / 2) ** 2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return r * c
+def connect_db() -> sqlite3.Connection:
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = db_pool.acquire()
+        _db_local.conn = conn
+        _db_local.changes_baseline = conn.total_changes
+    return conn
 
 
-def connect_db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH, timeout=30)
-    conn.row_factory = sqlite3.Row
+def db_has_changes() -> bool:
+    conn = getattr(_db_local, "conn", None)
+    return conn is not None and conn.total_changes != _db_local.changes_baseline
+
+
+def connect_db_readonly() -> sqlite3.Connection:
+    conn = getattr(_db_local, "reader", None)
+    if conn is None:
+        conn = db_reader_pool.acquire()
+        _db_local.reader = conn
     return conn
 
 
+def release_db() -> None:
+    conn = getattr(_db_local, "conn", None)
+    if conn is not None:
+        _db_local.conn = None
+        db_pool.release(conn)
+    reader = getattr(_db_local, "reader", None)
+    if reader is not None:
+        _db_local.reader = None
+        db_reader_pool.release(reader)
+
+
+def ensure_column(conn: sqlite3.Connection, table: str, column: str, definition: str) -> None:
+    columns = {row["name"] for row in conn.execute(f"PRAGMA table_xinfo({table})")}
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
 def init_db() -> None:
     DATA_DIR.mkdir(parents=True, exist_ok=True)
     with connect_db() as conn:
         conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA wal_autocheckpoint=1000;")
         conn.executescript(
             """
             CREATE TABLE IF NOT EXISTS users (
@@ -224,6 +496,7 @@ def init_db() -> None:
                 city TEXT NOT NULL,
                 start_at TEXT NOT NULL,
                 end_at TEXT NOT NULL,
+                start_ts INTEGER GENERATED ALWAYS AS (CAST(strftime('%s', start_at) AS INTEGER)) VIRTUAL,
                 status TEXT NOT NULL,
                 cancel_reason TEXT,
                 cancelled_at TEXT,
@@ -263,6 +536,7 @@ def init_db() -> None:
                 customer_requirements TEXT,
                 start_at TEXT NOT NULL,
                 end_at TEXT NOT NULL,
+                start_ts INTEGER GENERATED ALWAYS AS (CAST(strftime('%s', start_at) AS INTEGER)) VIRTUAL,
                 status TEXT NOT NULL,
                 cancelled_by TEXT,
                 cancellation_reason TEXT,
@@ -275,6 +549,7 @@ def init_db() -> None:
                 checkin_lng REAL,
                 distance_meters REAL,
                 photo_fallback_base64 TEXT,
+                photo_fallback_sha256 TEXT,
                 is_unique_visit INTEGER NOT NULL DEFAULT 0,
                 completion_mode TEXT,
                 completed_at TEXT,
@@ -371,20 +646,79 @@ def init_db() -> None:
                 created_at TEXT NOT NULL
             );
 
-            CREATE INDEX IF NOT EXISTS idx_properties_broker ON properties(broker_id);
+            DROP INDEX IF EXISTS idx_properties_broker;
+            CREATE INDEX IF NOT EXISTS idx_properties_broker_status ON properties(broker_id, status);
             CREATE INDEX IF NOT EXISTS idx_properties_status ON properties(status);
+            CREATE INDEX IF NOT EXISTS idx_properties_city_status ON properties(city, status);
+            CREATE INDEX IF NOT EXISTS idx_properties_city_created ON properties(city, created_at);
             CREATE INDEX IF NOT EXISTS idx_slots_broker ON slots(broker_id);
             CREATE INDEX IF NOT EXISTS idx_slots_status ON slots(status);
-            CREATE INDEX IF NOT EXISTS idx_visits_broker_status ON visits(broker_id, status);
-            CREATE INDEX IF NOT EXISTS idx_incidents_status ON cancellation_incidents(status);
+            CREATE INDEX IF NOT EXISTS idx_slots_broker_status_start ON slots(broker_id, status, start_at);
+            CREATE INDEX IF NOT EXISTS idx_properties_primary_status ON properties(primary_property_id, status)
+                WHERE primary_property_id IS NOT NULL;
+            CREATE INDEX IF NOT EXISTS idx_rm_assignments_broker ON rm_assignments(broker_id);
+            DROP INDEX IF EXISTS idx_visits_broker_status;
+            CREATE INDEX IF NOT EXISTS idx_visits_broker_status_start ON visits(broker_id, status, start_at);
+            CREATE INDEX IF NOT EXISTS idx_visits_customer ON visits(customer_id, status);
+            CREATE INDEX IF NOT EXISTS idx_visits_status_unique ON visits(status, is_unique_visit);
+            DROP INDEX IF EXISTS idx_customers_id_name;
+            CREATE INDEX IF NOT EXISTS idx_properties_id_title ON properties(id, title);
+            CREATE INDEX IF NOT EXISTS idx_slots_id_city ON slots(id, city);
+            DROP INDEX IF EXISTS idx_incidents_status;
+            CREATE INDEX IF NOT EXISTS idx_incidents_status_broker ON cancellation_incidents(status, broker_id);
+            CREATE INDEX IF NOT EXISTS idx_duplicate_queue_status_created ON duplicate_review_queue(status, created_at);
+            CREATE INDEX IF NOT EXISTS idx_incidents_broker_24h ON cancellation_incidents(broker_id, within_24h, is_booked);
             CREATE INDEX IF NOT EXISTS idx_flags_broker_status ON broker_flags(broker_id, status);
             CREATE INDEX IF NOT EXISTS idx_whatsapp_messages_to_phone ON whatsapp_messages(to_phone);
             CREATE INDEX IF NOT EXISTS idx_whatsapp_messages_visit ON whatsapp_messages(related_visit_id);
             CREATE INDEX IF NOT EXISTS idx_whatsapp_webhook_event_type ON whatsapp_webhook_events(event_type);
             """
         )
+        for table in ("slots", "visits"):
+            ensure_column(
+                conn,
+                table,
+                "start_ts",
+                "INTEGER GENERATED ALWAYS AS (CAST(strftime('%s', start_at) AS INTEGER)) VIRTUAL",
+            )
+        ensure_column(conn, "users", "active_flag_count", "INTEGER NOT NULL DEFAULT 0")
+        ensure_column(conn, "whatsapp_webhook_events", "provider_message_id", "TEXT")
+        ensure_column(conn, "visits", "photo_fallback_sha256", "TEXT")
+        conn.execute(
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_whatsapp_webhook_provider_message
+            ON whatsapp_webhook_events(provider_message_id)
+            WHERE provider_message_id IS NOT NULL
+            """
+        )
+        conn.executescript(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS broker_flags_ai AFTER INSERT ON broker_flags
+            WHEN NEW.status = '{FLAG_ACTIVE}'
+            BEGIN
+                UPDATE users SET active_flag_count = active_flag_count + 1 WHERE id = NEW.broker_id;
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS broker_flags_au AFTER UPDATE OF status, broker_id ON broker_flags
+            WHEN OLD.status IS NOT NEW.status OR OLD.broker_id IS NOT NEW.broker_id
+            BEGIN
+                UPDATE users SET active_flag_count = active_flag_count - 1
+                WHERE id = OLD.broker_id AND OLD.status = '{FLAG_ACTIVE}';
+                UPDATE users SET active_flag_count = active_flag_count + 1
+                WHERE id = NEW.broker_id AND NEW.status = '{FLAG_ACTIVE}';
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS broker_flags_ad AFTER DELETE ON broker_flags
+            WHEN OLD.status = '{FLAG_ACTIVE}'
+            BEGIN
+                UPDATE users SET active_flag_count = active_flag_count - 1 WHERE id = OLD.broker_id;
+            END;
+            """
+        )
 
-        now = to_iso(now_local())
+        conn.execute("BEGIN IMMEDIATE")
+        now_dt = now_local()
+        now = to_iso(now_dt)
         users_seed = [
             ("Broker Jaipur", "broker.jaipur@example.com", "broker123", ROLE_BROKER, "Jaipur"),
             ("Broker Nagpur", "broker.nagpur@example.com", "broker123", ROLE_BROKER, "Nagpur"),
@@ -392,30 +726,52 @@ def init_db() -> None:
             ("RM Nagpur", "rm.nagpur@example.com", "rm123", ROLE_RM, "Nagpur"),
             ("SRM Ops", "srm.ops@example.com", "srm123", ROLE_SRM, None),
         ]
-        for name, email, password, role, city in users_seed:
-            conn.execute(
-                """
-                INSERT INTO users(name, email, password_hash, role, city, active, created_at)
-                VALUES(?, ?, ?, ?, ?, 1, ?)
-                ON CONFLICT(email) DO NOTHING
-                """,
-                (name, email, hash_password(password), role, city, now),
+        existing_emails = {row["email"] for row in conn.execute("SELECT email FROM users")}
+        conn.executemany(
+            """
+            INSERT INTO users(name, email, password_hash, role, city, active, created_at)
+            VALUES(?, ?, ?, ?, ?, 1, ?)
+            ON CONFLICT(email) DO NOTHING
+            """,
+            [
+                (name, email, hash_password(password), role, city, now)
+                for name, email, password, role, city in users_seed
+                if email not in existing_emails
+            ],
+        )
+
+        conn.execute(
+            """
+            WITH counts(broker_id, c) AS (
+                SELECT users.id, COUNT(broker_flags.id)
+                FROM users
+                LEFT JOIN broker_flags ON broker_flags.broker_id = users.id AND broker_flags.status = ?
+                GROUP BY users.id
             )
+            UPDATE users
+            SET active_flag_count = counts.c
+            FROM counts
+            WHERE counts.broker_id = users.id AND users.active_flag_count != counts.c
+            """,
+            (FLAG_ACTIVE,),
+        )
 
         brokers = conn.execute("SELECT id, city FROM users WHERE role = ?", (ROLE_BROKER,)).fetchall()
         rms = conn.execute("SELECT id, city FROM users WHERE role = ?", (ROLE_RM,)).fetchall()
         rm_by_city = {row["city"]: row["id"] for row in rms}
-        for broker in brokers:
-            rm_id = rm_by_city.get(broker["city"])
-            if rm_id:
-                conn.execute(
-                    """
-                    INSERT INTO rm_assignments(rm_id, broker_id, created_at)
-                    VALUES(?, ?, ?)
-                    ON CONFLICT(rm_id, broker_id) DO NOTHING
-                    """,
-                    (rm_id, broker["id"], now),
-                )
+        conn.executemany(
+            """
+            INSERT INTO rm_assignments(rm_id, broker_id, created_at)
+            VALUES(?, ?, ?)
+            ON CONFLICT(rm_id, broker_id) DO NOTHING
+            """,
+            [
+                (rm_by_city[broker["city"]], broker["id"], now)
+                for broker in brokers
+                if rm_by_city.get(broker["city"])
+            ],
+        )
+        invalidate_assigned_brokers_cache()
 
         property_count = conn.execute("SELECT COUNT(*) AS c FROM properties").fetchone()["c"]
         if property_count == 0:
@@ -447,21 +803,22 @@ def init_db() -> None:
                     "image_url": "https://example.com/nagpur-orange-heights.jpg",
                 },
             ]
-            for item in sample_properties:
-                broker_id = conn.execute(
-                    "SELECT id FROM users WHERE email = ?", (item["broker_email"],)
-                ).fetchone()["id"]
-                conn.execute(
-                    """
-                    INSERT INTO properties(
-                        broker_id, title, asset_type, configuration, spec_value, spec_unit, bhk, area_value,
-                        location_text, city, price, maps_url, latitude, longitude, amenities, image_url,
-                        status, hidden_from_customers, duplicate_score, primary_property_id, created_at, updated_at
-                    )
-                    VALUES(?, ?, ?, ?, NULL, NULL, ?, NULL, ?, ?, ?, NULL, ?, ?, ?, ?, ?, 0, NULL, NULL, ?, ?)
-                    """,
+            broker_by_email = {
+                row["email"]: row["id"]
+                for row in conn.execute("SELECT id, email FROM users WHERE role = ?", (ROLE_BROKER,))
+            }
+            conn.executemany(
+                """
+                INSERT INTO properties(
+                    broker_id, title, asset_type, configuration, spec_value, spec_unit, bhk, area_value,
+                    location_text, city, price, maps_url, latitude, longitude, amenities, image_url,
+                    status, hidden_from_customers, duplicate_score, primary_property_id, created_at, updated_at
+                )
+                VALUES(?, ?, ?, ?, NULL, NULL, ?, NULL, ?, ?, ?, NULL, ?, ?, ?, ?, ?, 0, NULL, NULL, ?, ?)
+                """,
+                [
                     (
-                        broker_id,
+                        broker_by_email[item["broker_email"]],
                         item["title"],
                         item["asset_type"],
                         item["configuration"],
@@ -476,47 +833,75 @@ def init_db() -> None:
                         PROPERTY_STATUS_ACTIVE,
                         now,
                         now,
-                    ),
-                )
+                    )
+                    for item in sample_properties
+                ],
+            )
 
         slot_count = conn.execute("SELECT COUNT(*) AS c FROM slots").fetchone()["c"]
         if slot_count == 0:
-            for broker in brokers:
-                start = now_local().replace(hour=11, minute=0, second=0, microsecond=0) + timedelta(days=1)
-                end = start + timedelta(hours=2)
-                conn.execute(
-                    """
-                    INSERT INTO slots(broker_id, city, start_at, end_at, status, created_at, updated_at)
-                    VALUES(?, ?, ?, ?, ?, ?, ?)
-                    """,
-                    (broker["id"], broker["city"], to_iso(start), to_iso(end), SLOT_STATUS_OPEN, now, now),
-                )
-
-        seed_whatsapp_templates(conn)
+            start = now_dt.replace(hour=11, minute=0, second=0, microsecond=0) + timedelta(days=1)
+            end = start + timedelta(hours=2)
+            conn.executemany(
+                """
+                INSERT INTO slots(broker_id, city, start_at, end_at, status, created_at, updated_at)
+                VALUES(?, ?, ?, ?, ?, ?, ?)
+                """,
+                [
+                    (broker["id"], broker["city"], to_iso(start), to_iso(end), SLOT_STATUS_OPEN, now, now)
+                    for broker in brokers
+                ],
+            )
 
-        conn.commit()
+        seed_whatsapp_templates(conn, now)
+        conn.execute("PRAGMA optimize;")
 
 
-def record_event(conn: sqlite3.Connection, event_type: str, entity_type: str, entity_id: int | None, payload: dict | None = None) -> None:
+def record_event(
+    conn: sqlite3.Connection,
+    event_type: str,
+    entity_type: str,
+    entity_id: int | None,
+    payload: dict | None = None,
+    created_at: str | None = None,
+) -> None:
     conn.execute(
         """
         INSERT INTO events(event_type, entity_type, entity_id, payload_json, created_at)
         VALUES(?, ?, ?, ?, ?)
         """,
-        (event_type, entity_type, entity_id, json.dumps(payload or {}), to_iso(now_local())),
+        (event_type, entity_type, entity_id, dump_payload_json(payload), created_at or to_iso(now_local())),
+    )
+
+
+def record_events(
+    conn: sqlite3.Connection,
+    events: Iterable[tuple[str, str, int | None, dict | None]],
+    created_at: str | None = None,
+) -> None:
+    created_at = created_at or to_iso(now_local())
+    conn.executemany(
+        """
+        INSERT INTO events(event_type, entity_type, entity_id, payload_json, created_at)
+        VALUES(?, ?, ?, ?, ?)
+        """,
+        [
+            (event_type, entity_type, entity_id, dump_payload_json(payload), created_at)
+            for event_type, entity_type, entity_id, payload in events
+        ],
     )
 
 
+def calc_sla_due(raised_at: datetime) -> datetime:
+    return raised_at + SLA_WINDOW_BY_HOUR[raised_at.hour]
+
+
 def calc_rm_sla(raised_at: datetime) -> datetime:
-    if raised_at.hour < 12:
-        return raised_at + timedelta(hours=12)
-    return raised_at + timedelta(hours=24)
+    return calc_sla_due(raised_at)
 
 
 def calc_srm_sla(escalated_at: datetime) -> datetime:
-    if escalated_at.hour < 12:
-        return escalated_at + timedelta(hours=12)
-    return escalated_at + timedelta(hours=24)
+    return calc_sla_due(escalated_at)
 
 
 def calculate_tour_duration_minutes(property_count: int) -> int:
@@ -529,8 +914,8 @@ class SafeTemplateDict(dict):
         return "{" + key + "}"
 
 
-def seed_whatsapp_templates(conn: sqlite3.Connection) -> None:
-    now = to_iso(now_local())
+def seed_whatsapp_templates(conn: sqlite3.Connection, now: str | None = None) -> None:
+    now = now or to_iso(now_local())
     templates = [
         (
             "visit_confirmation",
@@ -569,19 +954,91 @@ def seed_whatsapp_templates(conn: sqlite3.Connection) -> None:
         ),
     ]
 
-    for template_name, language, body in templates:
-        conn.execute(
-            """
-            INSERT INTO whatsapp_templates(template_name, language, body, active, created_at)
-            VALUES(?, ?, ?, 1, ?)
-            ON CONFLICT(template_name, language) DO NOTHING
-            """,
-            (template_name, language, body, now),
-        )
+    conn.executemany(
+        """
+        INSERT INTO whatsapp_templates(template_name, language, body, active, created_at)
+        VALUES(?, ?, ?, 1, ?)
+        ON CONFLICT(template_name, language) DO NOTHING
+        """,
+        [(template_name, language, body, now) for template_name, language, body in templates],
+    )
+    invalidate_template_cache()
+
+
+_template_cache: dict[tuple[str, str], tuple[str, str, Callable[[dict], str]]] = {}
+_template_cache_lock = threading.Lock()
+
+
+def invalidate_template_cache() -> None:
+    with _template_cache_lock:
+        _template_cache.clear()
+
+
+def get_whatsapp_template(
+    conn: sqlite3.Connection,
+    template_name: str,
+    language: str = WHATSAPP_LANG,
+) -> tuple[str, str, Callable[[dict], str]] | None:
+    key = (template_name, language)
+    cached = _template_cache.get(key)
+    if cached is not None:
+        return cached
+
+    row = conn.execute(
+        """
+        SELECT body, language
+        FROM whatsapp_templates
+        WHERE template_name = ? AND language = ? AND active = 1
+        LIMIT 1
+        """,
+        key,
+    ).fetchone()
+    if not row:
+        return None
+
+    template = (row["body"], row["language"], compile_template(row["body"]))
+    with _template_cache_lock:
+        _template_cache[key] = template
+    return template
+
+
+_template_context_local = threading.local()
 
 
 def render_template(body: str, context: dict | None = None) -> str:
-    return body.format_map(SafeTemplateDict(context or {}))
+    safe_context = getattr(_template_context_local, "context", None)
+    if safe_context is None:
+        safe_context = SafeTemplateDict()
+        _template_context_local.context = safe_context
+    safe_context.clear()
+    if context:
+        safe_context.update(context)
+    try:
+        return body.format_map(safe_context)
+    finally:
+        safe_context.clear()
+
+
+def compile_template(body: str) -> Callable[[dict], str]:
+    parts: list[tuple[str, str | None]] = []
+    for literal, field_name, format_spec, conversion in string.Formatter().parse(body):
+        if field_name is not None and (not field_name.isidentifier() or format_spec or conversion):
+            return lambda context: render_template(body, context)
+        parts.append((literal, field_name))
+
+    def render(context: dict) -> str:
+        out: list[str] = []
+        for literal, field_name in parts:
+            out.append(literal)
+            if field_name is not None:
+                out.append(format(context[field_name], "") if field_name in context else "{" + field_name + "}")
+        return "".join(out)
+
+    return render
+
+
+FALLBACK_TEMPLATE_BODY = "Notification: {message}"
+render_fallback_template = compile_template(FALLBACK_TEMPLATE_BODY)
 
 
 def queue_whatsapp_message(
@@ -597,10 +1054,12 @@ def queue_whatsapp_message(
     payload: dict | None,
     status: str,
     related_visit_id: int | None,
+    created_at: str | None = None,
 ) -> dict:
-    provider_message_id = f"wa_{uuid.uuid4().hex[:14]}"
-    now = to_iso(now_local())
-    conn.execute(
+    provider_message_id = f"wa_{secrets.token_hex(7)}"
+    now = created_at or to_iso(now_local())
+    to_phone_norm = normalize_phone(to_phone) if to_phone else None
+    cursor = conn.execute(
         """
         INSERT INTO whatsapp_messages(
             direction, source, provider, to_phone, from_phone, template_name, language, message_text,
@@ -611,19 +1070,19 @@ def queue_whatsapp_message(
             direction,
             source,
             WHATSAPP_PROVIDER,
-            normalize_phone(to_phone) if to_phone else None,
+            to_phone_norm,
             normalize_phone(from_phone) if from_phone else None,
             template_name,
             language,
             message_text,
-            json.dumps(payload or {}),
+            dump_payload_json(payload),
             status,
             provider_message_id,
             related_visit_id,
             now,
         ),
     )
-    message_id = conn.execute("SELECT last_insert_rowid() AS id").fetchone()["id"]
+    message_id = cursor.lastrowid
     record_event(
         conn,
         "whatsapp_message_logged",
@@ -632,10 +1091,11 @@ def queue_whatsapp_message(
         {
             "direction": direction,
             "template_name": template_name,
-            "to_phone": normalize_phone(to_phone) if to_phone else None,
+            "to_phone": to_phone_norm,
             "status": status,
             "related_visit_id": related_visit_id,
         },
+        now,
     )
     return {"id": message_id, "provider_message_id": provider_message_id}
 
@@ -648,25 +1108,16 @@ def send_whatsapp_template(
     context: dict | None = None,
     related_visit_id: int | None = None,
     source: str = "system",
+    created_at: str | None = None,
 ) -> dict:
-    row = conn.execute(
-        """
-        SELECT body, language
-        FROM whatsapp_templates
-        WHERE template_name = ? AND language = ? AND active = 1
-        LIMIT 1
-        """,
-        (template_name, WHATSAPP_LANG),
-    ).fetchone()
-
-    if row:
-        body = row["body"]
-        language = row["language"]
+    template = get_whatsapp_template(conn, template_name)
+    if template:
+        _, language, render = template
     else:
-        body = "Notification: {message}"
         language = WHATSAPP_LANG
+        render = render_fallback_template
 
-    message_text = render_template(body, context or {})
+    message_text = render(context or {})
     return queue_whatsapp_message(
         conn,
         direction="outbound",
@@ -679,18 +1130,34 @@ def send_whatsapp_template(
         payload={"context": context or {}},
         status="queued",
         related_visit_id=related_visit_id,
+        created_at=created_at,
     )
 
 
-def log_whatsapp_webhook_event(conn: sqlite3.Connection, event_type: str, from_phone: str | None, payload: dict | None) -> int:
-    conn.execute(
+def log_whatsapp_webhook_event(
+    conn: sqlite3.Connection,
+    event_type: str,
+    from_phone: str | None,
+    payload: dict | None,
+    provider_message_id: str | None = None,
+    created_at: str | None = None,
+) -> int | None:
+    cursor = conn.execute(
         """
-        INSERT INTO whatsapp_webhook_events(event_type, from_phone, payload_json, created_at)
-        VALUES(?, ?, ?, ?)
+        INSERT OR IGNORE INTO whatsapp_webhook_events(event_type, from_phone, payload_json, provider_message_id, created_at)
+        VALUES(?, ?, ?, ?, ?)
         """,
-        (event_type, normalize_phone(from_phone) if from_phone else None, json.dumps(payload or {}), to_iso(now_local())),
+        (
+            event_type,
+            normalize_phone(from_phone) if from_phone else None,
+            dump_payload_json(payload),
+            provider_message_id,
+            created_at or to_iso(now_local()),
+        ),
     )
-    return conn.execute("SELECT last_insert_rowid() AS id").fetchone()["id"]
+    if cursor.rowcount == 0:
+        return None
+    return cursor.lastrowid
 
 
 def send_visit_whatsapp(
@@ -700,22 +1167,26 @@ def send_visit_whatsapp(
     template_name: str,
     source: str = "system",
     extra_context: dict | None = None,
+    visit_row: dict | None = None,
+    created_at: str | None = None,
 ) -> dict | None:
-    row = conn.execute(
-        """
-        SELECT
-            v.id AS visit_id,
-            v.start_at,
-            v.priority_rebook_until,
-            c.phone_norm,
-            p.title AS property_title
-        FROM visits v
-        JOIN customers c ON c.id = v.customer_id
-        JOIN properties p ON p.id = v.property_id
-        WHERE v.id = ?
-        """,
-        (visit_id,),
-    ).fetchone()
+    row = visit_row
+    if row is None:
+        row = conn.execute(
+            """
+            SELECT
+                v.id AS visit_id,
+                v.start_at,
+                v.priority_rebook_until,
+                c.phone_norm,
+                p.title AS property_title
+            FROM visits v
+            JOIN customers c ON c.id = v.customer_id
+            JOIN properties p ON p.id = v.property_id
+            WHERE v.id = ?
+            """,
+            (visit_id,),
+        ).fetchone()
     if not row:
         return None
 
@@ -733,18 +1204,21 @@ def send_visit_whatsapp(
         context=context,
         related_visit_id=visit_id,
         source=source,
+        created_at=created_at,
     )
 
 
 def create_scheduled_visit(
     conn: sqlite3.Connection,
     *,
-    slot_row: sqlite3.Row,
-    property_row: sqlite3.Row,
+    slot_row: sqlite3.Row | dict,
+    property_row: sqlite3.Row | dict,
     customer_id: int,
     customer_requirements: str,
     source: str,
     previous_visit_id: int | None = None,
+    customer_phone: str | None = None,
+    now: datetime | None = None,
 ) -> int:
     rm = conn.execute(
         "SELECT rm_id FROM rm_assignments WHERE broker_id = ? LIMIT 1",
@@ -752,9 +1226,16 @@ def create_scheduled_visit(
     ).fetchone()
     rm_id = rm["rm_id"] if rm else None
 
-    now_dt = now_local()
-    now = to_iso(now_dt)
-    conn.execute(
+    now_dt = now or now_local()
+    now_iso = to_iso(now_dt)
+    claimed = conn.execute(
+        "UPDATE slots SET status = ?, updated_at = ? WHERE id = ? AND status = ?",
+        (SLOT_STATUS_BOOKED, now_iso, slot_row["id"], SLOT_STATUS_OPEN),
+    )
+    if claimed.rowcount != 1:
+        raise ValueError("Slot not available")
+
+    cursor = conn.execute(
         """
         INSERT INTO visits(
             slot_id, property_id, broker_id, rm_id, customer_id, customer_requirements,
@@ -771,21 +1252,17 @@ def create_scheduled_visit(
             slot_row["start_at"],
             slot_row["end_at"],
             VISIT_STATUS_SCHEDULED,
-            now,
-            now,
+            now_iso,
+            now_iso,
         ),
     )
-    visit_id = conn.execute("SELECT last_insert_rowid() AS id").fetchone()["id"]
-
-    conn.execute(
-        "UPDATE slots SET status = ?, updated_at = ? WHERE id = ?",
-        (SLOT_STATUS_BOOKED, now, slot_row["id"]),
-    )
+    visit_id = cursor.lastrowid
 
-    start_at = parse_iso(slot_row["start_at"])
+    start_ts = slot_row["start_ts"]
+    immediate = start_ts is not None and (start_ts - to_epoch_seconds(now_dt)) < DAY_SECONDS
     reminder_due = now_dt
-    if start_at:
-        reminder_due = now_dt if (start_at - now_dt) < timedelta(hours=24) else (start_at - timedelta(days=1))
+    if start_ts is not None and not immediate:
+        reminder_due = EPOCH + timedelta(seconds=start_ts - DAY_SECONDS)
     record_event(
         conn,
         "rm_reminder_scheduled",
@@ -794,9 +1271,10 @@ def create_scheduled_visit(
         {
             "rm_id": rm_id,
             "due_at": to_iso(reminder_due),
-            "immediate": bool(start_at and (start_at - now_dt) < timedelta(hours=24)),
+            "immediate": immediate,
             "source": source,
         },
+        now_iso,
     )
     record_event(
         conn,
@@ -804,62 +1282,118 @@ def create_scheduled_visit(
         "visit",
         visit_id,
         {"source": source, "previous_visit_id": previous_visit_id},
+        now_iso,
+    )
+    send_visit_whatsapp(
+        conn,
+        visit_id=visit_id,
+        template_name="visit_confirmation",
+        source=source,
+        visit_row=scheduled_visit_row(visit_id, slot_row, property_row, customer_phone),
+        created_at=now_iso,
     )
-    send_visit_whatsapp(conn, visit_id=visit_id, template_name="visit_confirmation", source=source)
     return visit_id
 
 
-def get_rebooking_slots_for_visit(conn: sqlite3.Connection, visit_row: sqlite3.Row) -> list[dict]:
-    now = to_iso(now_local())
-    primary_broker_id = visit_row["broker_id"]
-    broker_to_property: dict[int, int] = {primary_broker_id: visit_row["property_id"]}
+def scheduled_visit_row(
+    visit_id: int,
+    slot_row: sqlite3.Row | dict,
+    property_row: sqlite3.Row | dict,
+    customer_phone: str | None,
+) -> dict | None:
+    if not customer_phone:
+        return None
+    return {
+        "visit_id": visit_id,
+        "start_at": slot_row["start_at"],
+        "priority_rebook_until": None,
+        "phone_norm": customer_phone,
+        "property_title": property_row["title"],
+    }
+
+
+def get_rebooking_slots_for_visit(
+    conn: sqlite3.Connection,
+    visit_row: sqlite3.Row,
+    now: datetime | None = None,
+) -> list[dict]:
+    return get_rebooking_slots_for_visits(conn, [visit_row], now).get(visit_row["id"], [])
+
+
+def get_rebooking_slots_for_visits(
+    conn: sqlite3.Connection,
+    visit_rows: list[sqlite3.Row],
+    now: datetime | None = None,
+) -> dict[int, list[dict]]:
+    if not visit_rows:
+        return {}
+    now_iso = to_iso(now or now_local())
+    property_ids = list({row["property_id"] for row in visit_rows})
 
+    backups_by_property: dict[int, list[sqlite3.Row]] = {}
     backup_rows = conn.execute(
         """
-        SELECT id, broker_id
+        SELECT id, broker_id, primary_property_id
         FROM properties
-        WHERE primary_property_id = ?
+        WHERE primary_property_id IN (SELECT value FROM json_each(?))
           AND status IN (?, ?)
+        ORDER BY id ASC
         """,
-        (visit_row["property_id"], PROPERTY_STATUS_BACKUP, PROPERTY_STATUS_ACTIVE),
+        (json.dumps(property_ids), PROPERTY_STATUS_BACKUP, PROPERTY_STATUS_ACTIVE),
     ).fetchall()
     for row in backup_rows:
-        if row["broker_id"] not in broker_to_property:
-            broker_to_property[row["broker_id"]] = row["id"]
+        backups_by_property.setdefault(row["primary_property_id"], []).append(row)
 
-    broker_ids = list(broker_to_property.keys())
-    if not broker_ids:
-        return []
+    mappings: dict[int, dict[int, int]] = {}
+    for visit_row in visit_rows:
+        broker_to_property: dict[int, int] = {visit_row["broker_id"]: visit_row["property_id"]}
+        for row in backups_by_property.get(visit_row["property_id"], []):
+            if row["broker_id"] not in broker_to_property:
+                broker_to_property[row["broker_id"]] = row["id"]
+        mappings[visit_row["id"]] = broker_to_property
 
+    broker_ids = list({broker_id for mapping in mappings.values() for broker_id in mapping})
     slots = conn.execute(
-        f"""
-        SELECT *
-        FROM slots
-        WHERE broker_id IN ({','.join('?' for _ in broker_ids)})
-          AND status = ?
-          AND start_at >= ?
-        ORDER BY start_at ASC
-        LIMIT 20
+        """
+        SELECT id, broker_id, start_at, end_at, city
+        FROM (
+            SELECT
+                *,
+                ROW_NUMBER() OVER (PARTITION BY broker_id ORDER BY start_at ASC, id ASC) AS broker_rank
+            FROM slots
+            WHERE broker_id IN (SELECT value FROM json_each(?))
+              AND status = ?
+              AND start_at >= ?
+        )
+        WHERE broker_rank <= 20
+        ORDER BY start_at ASC, id ASC
         """,
-        (*broker_ids, SLOT_STATUS_OPEN, now),
+        (json.dumps(broker_ids), SLOT_STATUS_OPEN, now_iso),
     ).fetchall()
 
-    available: list[dict] = []
-    for slot in slots:
-        mapped_property = broker_to_property.get(slot["broker_id"])
-        if not mapped_property:
-            continue
-        available.append(
-            {
-                "slot_id": slot["id"],
-                "broker_id": slot["broker_id"],
-                "property_id": mapped_property,
-                "start_at": slot["start_at"],
-                "end_at": slot["end_at"],
-                "city": slot["city"],
-                "mode": "primary" if slot["broker_id"] == primary_broker_id else "backup",
-            }
-        )
+    available: dict[int, list[dict]] = {}
+    for visit_row in visit_rows:
+        primary_broker_id = visit_row["broker_id"]
+        broker_to_property = mappings[visit_row["id"]]
+        items: list[dict] = []
+        for slot in slots:
+            mapped_property = broker_to_property.get(slot["broker_id"])
+            if not mapped_property:
+                continue
+            items.append(
+                {
+                    "slot_id": slot["id"],
+                    "broker_id": slot["broker_id"],
+                    "property_id": mapped_property,
+                    "start_at": slot["start_at"],
+                    "end_at": slot["end_at"],
+                    "city": slot["city"],
+                    "mode": "primary" if slot["broker_id"] == primary_broker_id else "backup",
+                }
+            )
+            if len(items) >= 20:
+                break
+        available[visit_row["id"]] = items
     return available
 
 
@@ -870,16 +1404,19 @@ def cancel_visit_by_customer(
     customer_phone: str,
     reason: str,
     source: str,
+    now: datetime | None = None,
 ) -> dict:
     phone = normalize_phone(customer_phone)
     visit = conn.execute(
-        """
+        f"""
         SELECT
-            v.*,
+            {VISIT_COLUMNS},
             c.phone_norm,
-            c.name AS customer_name
+            c.name AS customer_name,
+            p.title AS property_title
         FROM visits v
         JOIN customers c ON c.id = v.customer_id
+        JOIN properties p ON p.id = v.property_id
         WHERE v.id = ?
         """,
         (visit_id,),
@@ -891,18 +1428,20 @@ def cancel_visit_by_customer(
     if visit["status"] != VISIT_STATUS_SCHEDULED:
         raise ValueError("Only scheduled visits can be cancelled")
 
-    now = to_iso(now_local())
-    conn.execute(
+    now_iso = to_iso(now or now_local())
+    cursor = conn.execute(
         """
         UPDATE visits
         SET status = ?, cancelled_by = ?, cancellation_reason = ?, updated_at = ?
-        WHERE id = ?
+        WHERE id = ? AND status = ?
         """,
-        (VISIT_STATUS_CANCELLED_CUSTOMER, "customer", reason or "customer_requested", now, visit_id),
+        (VISIT_STATUS_CANCELLED_CUSTOMER, "customer", reason or "customer_requested", now_iso, visit_id, VISIT_STATUS_SCHEDULED),
     )
+    if cursor.rowcount != 1:
+        raise ValueError("Only scheduled visits can be cancelled")
     conn.execute(
         "UPDATE slots SET status = ?, updated_at = ? WHERE id = ?",
-        (SLOT_STATUS_OPEN, now, visit["slot_id"]),
+        (SLOT_STATUS_OPEN, now_iso, visit["slot_id"]),
     )
     record_event(
         conn,
@@ -910,8 +1449,22 @@ def cancel_visit_by_customer(
         "visit",
         visit_id,
         {"source": source, "reason": reason or "customer_requested"},
+        now_iso,
+    )
+    send_visit_whatsapp(
+        conn,
+        visit_id=visit_id,
+        template_name="customer_cancel_confirmation",
+        source=source,
+        visit_row={
+            "visit_id": visit_id,
+            "start_at": visit["start_at"],
+            "priority_rebook_until": visit["priority_rebook_until"],
+            "phone_norm": visit["phone_norm"],
+            "property_title": visit["property_title"],
+        },
+        created_at=now_iso,
     )
-    send_visit_whatsapp(conn, visit_id=visit_id, template_name="customer_cancel_confirmation", source=source)
     return {"visit_id": visit_id, "status": VISIT_STATUS_CANCELLED_CUSTOMER}
 
 
@@ -923,12 +1476,13 @@ def reschedule_visit_by_customer(
     target_slot_id: int,
     reason: str,
     source: str,
+    now: datetime | None = None,
 ) -> dict:
     phone = normalize_phone(customer_phone)
     visit = conn.execute(
-        """
+        f"""
         SELECT
-            v.*,
+            {VISIT_COLUMNS},
             c.phone_norm
         FROM visits v
         JOIN customers c ON c.id = v.customer_id
@@ -943,7 +1497,8 @@ def reschedule_visit_by_customer(
     if visit["status"] != VISIT_STATUS_SCHEDULED:
         raise ValueError("Only scheduled visits can be rescheduled")
 
-    allowed_slots = get_rebooking_slots_for_visit(conn, visit)
+    now = now or now_local()
+    allowed_slots = get_rebooking_slots_for_visit(conn, visit, now)
     selected = next((slot for slot in allowed_slots if slot["slot_id"] == target_slot_id), None)
     if not selected:
         raise ValueError("Selected slot is not allowed for this visit")
@@ -962,7 +1517,18 @@ def reschedule_visit_by_customer(
     if not property_row:
         raise ValueError("Property mapping not found for selected slot")
 
-    now = to_iso(now_local())
+    now_iso = to_iso(now)
+    new_visit_id = create_scheduled_visit(
+        conn,
+        slot_row=slot,
+        property_row=property_row,
+        customer_id=visit["customer_id"],
+        customer_requirements=visit["customer_requirements"] or "",
+        source=source,
+        previous_visit_id=visit_id,
+        customer_phone=visit["phone_norm"],
+        now=now,
+    )
     conn.execute(
         """
         UPDATE visits
@@ -973,23 +1539,13 @@ def reschedule_visit_by_customer(
             VISIT_STATUS_RESCHEDULED,
             "customer",
             f"rescheduled_by_customer:{reason or 'customer_requested'}",
-            now,
+            now_iso,
             visit_id,
         ),
     )
     conn.execute(
         "UPDATE slots SET status = ?, updated_at = ? WHERE id = ?",
-        (SLOT_STATUS_OPEN, now, visit["slot_id"]),
-    )
-
-    new_visit_id = create_scheduled_visit(
-        conn,
-        slot_row=slot,
-        property_row=property_row,
-        customer_id=visit["customer_id"],
-        customer_requirements=visit["customer_requirements"] or "",
-        source=source,
-        previous_visit_id=visit_id,
+        (SLOT_STATUS_OPEN, now_iso, visit["slot_id"]),
     )
     send_visit_whatsapp(
         conn,
@@ -997,6 +1553,8 @@ def reschedule_visit_by_customer(
         template_name="visit_rescheduled_confirmation",
         source=source,
         extra_context={"old_visit_id": visit_id, "new_visit_id": new_visit_id},
+        visit_row=scheduled_visit_row(new_visit_id, slot, property_row, visit["phone_norm"]),
+        created_at=now_iso,
     )
     record_event(
         conn,
@@ -1004,111 +1562,224 @@ def reschedule_visit_by_customer(
         "visit",
         visit_id,
         {"new_visit_id": new_visit_id, "source": source},
+        now_iso,
     )
     return {"old_visit_id": visit_id, "new_visit_id": new_visit_id}
 
 
-def csv_text(headers: list[str], rows: list[list]) -> str:
-    buff = io.StringIO()
-    writer = csv.writer(buff)
-    writer.writerow(headers)
-    writer.writerows(rows)
-    return buff.getvalue()
+def send_whatsapp_help(
+    conn: sqlite3.Connection,
+    to_phone: str,
+    context: dict | None = None,
+    created_at: str | None = None,
+) -> None:
+    send_whatsapp_template(
+        conn,
+        to_phone=to_phone,
+        template_name="customer_help",
+        context=context or {},
+        source="whatsapp_webhook",
+        created_at=created_at,
+    )
 
 
-def build_funnel_report(conn: sqlite3.Connection) -> dict:
-    lead_count = conn.execute("SELECT COUNT(*) AS c FROM leads").fetchone()["c"]
-    scheduled = conn.execute(
-        "SELECT COUNT(*) AS c FROM visits WHERE status = ?",
-        (VISIT_STATUS_SCHEDULED,),
-    ).fetchone()["c"]
-    completed_unique = conn.execute(
-        "SELECT COUNT(*) AS c FROM visits WHERE status = ? AND is_unique_visit = 1",
-        (VISIT_STATUS_COMPLETED,),
-    ).fetchone()["c"]
-    completed_non_unique = conn.execute(
-        "SELECT COUNT(*) AS c FROM visits WHERE status = ? AND is_unique_visit = 0",
-        (VISIT_STATUS_COMPLETED,),
-    ).fetchone()["c"]
-    broker_cancellations_lt24h = conn.execute(
-        """
-        SELECT COUNT(*) AS c
-        FROM cancellation_incidents
-        WHERE within_24h = 1 AND is_booked = 1
-        """,
-    ).fetchone()["c"]
-    customer_cancellations = conn.execute(
-        "SELECT COUNT(*) AS c FROM visits WHERE status = ?",
-        (VISIT_STATUS_CANCELLED_CUSTOMER,),
-    ).fetchone()["c"]
-    customer_reschedules = conn.execute(
-        "SELECT COUNT(*) AS c FROM visits WHERE status = ?",
-        (VISIT_STATUS_RESCHEDULED,),
-    ).fetchone()["c"]
+def whatsapp_help_command(conn: sqlite3.Connection, match: re.Match, from_phone: str, now: datetime) -> dict:
+    send_whatsapp_help(conn, from_phone, created_at=to_iso(now))
+    return {"action": "help_sent"}
 
-    return {
-        "lead_count": lead_count,
-        "scheduled_visits": scheduled,
-        "completed_unique": completed_unique,
-        "completed_non_unique": completed_non_unique,
-        "broker_cancellations_lt24h": broker_cancellations_lt24h,
-        "customer_cancellations": customer_cancellations,
-        "customer_reschedules": customer_reschedules,
-    }
 
+def whatsapp_cancel_command(conn: sqlite3.Connection, match: re.Match, from_phone: str, now: datetime) -> dict:
+    try:
+        result = cancel_visit_by_customer(
+            conn,
+            visit_id=int(match.group(1)),
+            customer_phone=from_phone,
+            reason="customer_whatsapp_cancel",
+            source="whatsapp_webhook",
+            now=now,
+        )
+    except ValueError as exc:
+        send_whatsapp_help(conn, from_phone, {"message": str(exc)}, to_iso(now))
+        return {"action": "cancel_failed", "error": str(exc)}
+    return {"action": "visit_cancelled", "result": result}
 
-def build_broker_reliability_report(conn: sqlite3.Connection) -> list[dict]:
-    brokers = conn.execute(
-        "SELECT id, name, city, active FROM users WHERE role = ? ORDER BY name ASC",
-        (ROLE_BROKER,),
-    ).fetchall()
-    report: list[dict] = []
-    for broker in brokers:
-        total = conn.execute(
-            "SELECT COUNT(*) AS c FROM visits WHERE broker_id = ?",
-            (broker["id"],),
-        ).fetchone()["c"]
-        completed = conn.execute(
-            "SELECT COUNT(*) AS c FROM visits WHERE broker_id = ? AND status = ?",
-            (broker["id"], VISIT_STATUS_COMPLETED),
-        ).fetchone()["c"]
-        broker_cancelled = conn.execute(
-            "SELECT COUNT(*) AS c FROM visits WHERE broker_id = ? AND status = ?",
-            (broker["id"], VISIT_STATUS_CANCELLED_BROKER),
-        ).fetchone()["c"]
-        late_cancel_incidents = conn.execute(
+
+def whatsapp_reschedule_command(conn: sqlite3.Connection, match: re.Match, from_phone: str, now: datetime) -> dict:
+    try:
+        result = reschedule_visit_by_customer(
+            conn,
+            visit_id=int(match.group(1)),
+            customer_phone=from_phone,
+            target_slot_id=int(match.group(2)),
+            reason="customer_whatsapp_reschedule",
+            source="whatsapp_webhook",
+            now=now,
+        )
+    except ValueError as exc:
+        send_whatsapp_help(conn, from_phone, {"message": str(exc)}, to_iso(now))
+        return {"action": "reschedule_failed", "error": str(exc)}
+    return {"action": "visit_rescheduled", "result": result}
+
+
+WHATSAPP_COMMANDS: tuple[tuple[re.Pattern, Callable[[sqlite3.Connection, re.Match, str, datetime], dict]], ...] = (
+    (HELP_COMMAND_RE, whatsapp_help_command),
+    (CANCEL_COMMAND_RE, whatsapp_cancel_command),
+    (RESCHEDULE_COMMAND_RE, whatsapp_reschedule_command),
+)
+
+
+def handle_whatsapp_command(conn: sqlite3.Connection, from_phone: str, message_text: str, now: datetime) -> dict:
+    upper = message_text.strip().upper()
+    for pattern, command in WHATSAPP_COMMANDS:
+        match = pattern.match(upper)
+        if match:
+            return command(conn, match, from_phone, now)
+    send_whatsapp_help(conn, from_phone, created_at=to_iso(now))
+    return {"action": "unknown_command_help_sent"}
+
+
+def write_csv(fp: TextIO, headers: list[str], rows: Iterable[Iterable]) -> None:
+    writer = csv.writer(fp)
+    writer.writerow(headers)
+    writer.writerows(rows)
+
+
+def build_dashboard_metrics(conn: sqlite3.Connection, user: sqlite3.Row, now_iso: str) -> dict:
+    if user["role"] == ROLE_BROKER:
+        row = conn.execute(
+            """
+            SELECT
+                (
+                    SELECT COUNT(*)
+                    FROM properties
+                    WHERE broker_id = ? AND status IN (?, ?)
+                ) AS inventory,
+                (
+                    SELECT COUNT(*)
+                    FROM visits
+                    WHERE broker_id = ? AND status = ? AND start_at >= ?
+                ) AS upcoming_visits,
+                COALESCE((SELECT active_flag_count FROM users WHERE id = ?), 0) AS active_flags
+            """,
+            (
+                user["id"],
+                PROPERTY_STATUS_ACTIVE,
+                PROPERTY_STATUS_BACKUP,
+                user["id"],
+                VISIT_STATUS_SCHEDULED,
+                now_iso,
+                user["id"],
+            ),
+        ).fetchone()
+        return dict(row)
+
+    if user["role"] == ROLE_RM:
+        row = conn.execute(
             """
-            SELECT COUNT(*) AS c
-            FROM cancellation_incidents
-            WHERE broker_id = ? AND within_24h = 1 AND is_booked = 1
+            WITH assigned(broker_id) AS (
+                SELECT broker_id FROM rm_assignments WHERE rm_id = ?
+            )
+            SELECT
+                (SELECT COUNT(*) FROM assigned) AS assigned_brokers,
+                (
+                    SELECT COUNT(*)
+                    FROM duplicate_review_queue dq
+                    JOIN properties p ON p.id = dq.property_id
+                    WHERE dq.status = 'pending' AND p.broker_id IN (SELECT broker_id FROM assigned)
+                ) AS duplicate_queue,
+                (
+                    SELECT COUNT(*)
+                    FROM cancellation_incidents
+                    WHERE status = ? AND broker_id IN (SELECT broker_id FROM assigned)
+                ) AS emergency_queue
             """,
-            (broker["id"],),
-        ).fetchone()["c"]
-        active_flags = conn.execute(
-            "SELECT COUNT(*) AS c FROM broker_flags WHERE broker_id = ? AND status = ?",
-            (broker["id"], FLAG_ACTIVE),
-        ).fetchone()["c"]
-        completion_rate = round((completed / total) * 100, 2) if total else 0.0
+            (user["id"], INCIDENT_PENDING_RM),
+        ).fetchone()
+        return dict(row)
+
+    escalations = conn.execute(
+        "SELECT COUNT(*) AS c FROM cancellation_incidents WHERE status = ?",
+        (INCIDENT_ESCALATED,),
+    ).fetchone()["c"]
+    return {"escalations": escalations}
+
+
+def build_funnel_report(conn: sqlite3.Connection) -> dict:
+    row = conn.execute(
+        """
+        SELECT
+            (SELECT COUNT(*) FROM leads) AS lead_count,
+            COUNT(*) FILTER (WHERE status = :scheduled) AS scheduled_visits,
+            COUNT(*) FILTER (WHERE status = :completed AND is_unique_visit = 1) AS completed_unique,
+            COUNT(*) FILTER (WHERE status = :completed AND is_unique_visit = 0) AS completed_non_unique,
+            (
+                SELECT COUNT(*)
+                FROM cancellation_incidents
+                WHERE within_24h = 1 AND is_booked = 1
+            ) AS broker_cancellations_lt24h,
+            COUNT(*) FILTER (WHERE status = :cancelled_customer) AS customer_cancellations,
+            COUNT(*) FILTER (WHERE status = :rescheduled) AS customer_reschedules
+        FROM visits
+        """,
+        {
+            "scheduled": VISIT_STATUS_SCHEDULED,
+            "completed": VISIT_STATUS_COMPLETED,
+            "cancelled_customer": VISIT_STATUS_CANCELLED_CUSTOMER,
+            "rescheduled": VISIT_STATUS_RESCHEDULED,
+        },
+    ).fetchone()
+    return dict(row)
 
+
+def build_broker_reliability_report(conn: sqlite3.Connection) -> list[dict]:
+    rows = conn.execute(
+        """
+        SELECT
+            u.id AS broker_id,
+            u.name AS broker_name,
+            u.city,
+            u.active,
+            COUNT(v.id) AS total_visits,
+            COUNT(v.id) FILTER (WHERE v.status = :completed) AS completed_visits,
+            COUNT(v.id) FILTER (WHERE v.status = :cancelled_broker) AS broker_cancelled_visits,
+            (
+                SELECT COUNT(*)
+                FROM cancellation_incidents ci
+                WHERE ci.broker_id = u.id AND ci.within_24h = 1 AND ci.is_booked = 1
+            ) AS late_cancel_incidents,
+            u.active_flag_count AS active_flags
+        FROM users u
+        LEFT JOIN visits v ON v.broker_id = u.id
+        WHERE u.role = :role
+        GROUP BY u.id
+        ORDER BY u.name ASC
+        """,
+        {"completed": VISIT_STATUS_COMPLETED, "cancelled_broker": VISIT_STATUS_CANCELLED_BROKER, "role": ROLE_BROKER},
+    )
+
+    report: list[dict] = []
+    for row in rows:
+        total = row["total_visits"]
+        completed = row["completed_visits"]
         report.append(
             {
-                "broker_id": broker["id"],
-                "broker_name": broker["name"],
-                "city": broker["city"],
-                "active": broker["active"],
+                "broker_id": row["broker_id"],
+                "broker_name": row["broker_name"],
+                "city": row["city"],
+                "active": row["active"],
                 "total_visits": total,
                 "completed_visits": completed,
-                "completion_rate_pct": completion_rate,
-                "broker_cancelled_visits": broker_cancelled,
-                "late_cancel_incidents": late_cancel_incidents,
-                "active_flags": active_flags,
+                "completion_rate_pct": round((completed / total) * 100, 2) if total else 0.0,
+                "broker_cancelled_visits": row["broker_cancelled_visits"],
+                "late_cancel_incidents": row["late_cancel_incidents"],
+                "active_flags": row["active_flags"],
             }
         )
     return report
 
 
-def decay_flags(conn: sqlite3.Connection) -> None:
-    now = now_local()
+def decay_flags(conn: sqlite3.Connection, now: datetime | None = None) -> None:
+    now = now or now_local()
     conn.execute(
         """
         UPDATE broker_flags
@@ -1120,22 +1791,21 @@ def decay_flags(conn: sqlite3.Connection) -> None:
 
 
 def active_flag_count(conn: sqlite3.Connection, broker_id: int) -> int:
-    row = conn.execute(
-        """
-        SELECT COUNT(*) AS c
-        FROM broker_flags
-        WHERE broker_id = ? AND status = ?
-        """,
-        (broker_id, FLAG_ACTIVE),
-    ).fetchone()
-    return row["c"] if row else 0
+    row = conn.execute("SELECT active_flag_count FROM users WHERE id = ?", (broker_id,)).fetchone()
+    return row["active_flag_count"] if row else 0
 
 
-def apply_flag(conn: sqlite3.Connection, broker_id: int, incident_id: int | None, reason: str) -> dict:
-    decay_flags(conn)
+def apply_flag(
+    conn: sqlite3.Connection,
+    broker_id: int,
+    incident_id: int | None,
+    reason: str,
+    now: datetime | None = None,
+) -> dict:
+    now = now or now_local()
+    decay_flags(conn, now)
     count = active_flag_count(conn, broker_id)
     level = count + 1
-    now = now_local()
     decays_at = now + timedelta(days=90)
 
     conn.execute(
@@ -1158,12 +1828,14 @@ def apply_flag(conn: sqlite3.Connection, broker_id: int, incident_id: int | None
 
     if level >= 3:
         conn.execute("UPDATE users SET active = 0 WHERE id = ?", (broker_id,))
+        invalidate_auth_cache(broker_id)
         record_event(
             conn,
             "broker_removed_after_third_flag",
             "broker",
             broker_id,
             {"level": level, "reason": reason},
+            to_iso(now),
         )
 
     record_event(
@@ -1172,45 +1844,38 @@ def apply_flag(conn: sqlite3.Connection, broker_id: int, incident_id: int | None
         "broker",
         broker_id,
         {"level": level, "reason": reason, "incident_id": incident_id},
+        to_iso(now),
     )
     return {"level": level, "decays_at": to_iso(decays_at)}
 
 
-def process_incident_escalations(conn: sqlite3.Connection) -> None:
-    now = now_local()
-    pending = conn.execute(
+def process_incident_escalations(conn: sqlite3.Connection, now: datetime | None = None) -> None:
+    now = now or now_local()
+    now_iso = to_iso(now)
+    srm_due_at = to_iso(calc_srm_sla(now))
+    escalated = conn.execute(
         """
-        SELECT id
-        FROM cancellation_incidents
+        UPDATE cancellation_incidents
+        SET status = ?, escalated_to_srm = 1, srm_due_at = ?, updated_at = ?
         WHERE status = ? AND escalated_to_srm = 0 AND sla_due_at IS NOT NULL AND sla_due_at <= ?
+        RETURNING id
         """,
-        (INCIDENT_PENDING_RM, to_iso(now)),
+        (INCIDENT_ESCALATED, srm_due_at, now_iso, INCIDENT_PENDING_RM, now_iso),
     ).fetchall()
-
-    for row in pending:
-        srm_due_at = calc_srm_sla(now)
-        conn.execute(
-            """
-            UPDATE cancellation_incidents
-            SET status = ?, escalated_to_srm = 1, srm_due_at = ?, updated_at = ?
-            WHERE id = ?
-            """,
-            (INCIDENT_ESCALATED, to_iso(srm_due_at), to_iso(now), row["id"]),
-        )
-        record_event(
-            conn,
-            "incident_escalated_to_srm",
-            "cancellation_incident",
-            row["id"],
-            {"srm_due_at": to_iso(srm_due_at)},
-        )
+    if not escalated:
+        return
+    record_events(
+        conn,
+        (
+            ("incident_escalated_to_srm", "cancellation_incident", incident_id, {"srm_due_at": srm_due_at})
+            for incident_id in sorted(row["id"] for row in escalated)
+        ),
+        now_iso,
+    )
 
 
 def parse_request_body(handler: BaseHTTPRequestHandler) -> dict:
-    length = int(handler.headers.get("Content-Length", "0"))
-    if length <= 0:
-        return {}
-    raw = handler.rfile.read(length)
+    raw = handler.request_body
     if not raw:
         return {}
     try:
@@ -1219,92 +1884,151 @@ def parse_request_body(handler: BaseHTTPRequestHandler) -> dict:
         return {}
 
 
-def compute_similarity(new_prop: sqlite3.Row, old_prop: sqlite3.Row) -> float:
-    image_score = 0.0
-    new_img = normalize_text(new_prop["image_url"])
-    old_img = normalize_text(old_prop["image_url"])
-    if new_img and old_img:
-        if new_img == old_img:
-            image_score = 1.0
+def coerce_fields(data: dict, fields: tuple[tuple[str, Callable | None, bool], ...]) -> tuple:
+    values = []
+    missing = []
+    for name, convert, required in fields:
+        value = data.get(name)
+        if not value:
+            if required:
+                missing.append(name)
+            values.append(None if convert else value)
+        elif convert:
+            values.append(convert(value))
         else:
-            image_score = max(
-                text_similarity(os.path.basename(new_img), os.path.basename(old_img)) * 0.8,
-                text_similarity(new_img, old_img) * 0.5,
-            )
+            values.append(value)
+    if missing:
+        raise ValueError(f"Missing fields: {', '.join(missing)}")
+    return tuple(values)
+
+
+def store_visit_photo(photo: str) -> str:
+    data = base64.b64decode(photo.rpartition(",")[2], validate=True)
+    if not data:
+        raise ValueError("Empty photo")
+    digest = hashlib.sha256(data).hexdigest()
+    target = PHOTOS_DIR / digest
+    if not target.exists():
+        PHOTOS_DIR.mkdir(parents=True, exist_ok=True)
+        partial = target.with_suffix(f".{secrets.token_hex(4)}.tmp")
+        partial.write_bytes(data)
+        os.replace(partial, target)
+    return digest
+
+
+def compute_similarity_batch(new_prop: sqlite3.Row, candidates: list[sqlite3.Row]) -> list[float]:
+    new_img = normalize_text(new_prop["image_url"])
+    new_img_base = normalize_text(os.path.basename(new_img))
+    new_loc = normalize_text(new_prop["location_text"])
+    new_type = normalize_text(new_prop["asset_type"])
+    new_config = normalize_text(new_prop["configuration"])
+    new_area = float(new_prop["area_value"]) if new_prop["area_value"] else None
+    new_price = float(new_prop["price"]) if new_prop["price"] else None
+
+    distances: list[float | None] = [None] * len(candidates)
+    if new_prop["latitude"] is not None and new_prop["longitude"] is not None:
+        distances = haversine_meters_batch(
+            new_prop["latitude"],
+            new_prop["longitude"],
+            [(candidate["latitude"], candidate["longitude"]) for candidate in candidates],
+        )
 
-    loc_score = text_similarity(new_prop["location_text"], old_prop["location_text"])
-    if new_prop["latitude"] is not None and new_prop["longitude"] is not None and old_prop["latitude"] is not None and old_prop["longitude"] is not None:
-        distance = haversine_meters(new_prop["latitude"], new_prop["longitude"], old_prop["latitude"], old_prop["longitude"])
-        geo_score = 1.0 if distance <= 60 else max(0.0, 1.0 - (distance / 4000.0))
-        loc_score = max(loc_score, geo_score)
-
-    type_score = 1.0 if normalize_text(new_prop["asset_type"]) == normalize_text(old_prop["asset_type"]) else 0.0
-    config_score = text_similarity(new_prop["configuration"], old_prop["configuration"])
-
-    area_score = 0.0
-    if new_prop["area_value"] and old_prop["area_value"]:
-        diff = abs(float(new_prop["area_value"]) - float(old_prop["area_value"]))
-        area_score = max(0.0, 1.0 - diff / max(float(new_prop["area_value"]), float(old_prop["area_value"]), 1.0))
-    specifics_score = (type_score * 0.45) + (config_score * 0.4) + (area_score * 0.15)
-
-    price_score = 0.0
-    if new_prop["price"] and old_prop["price"]:
-        diff = abs(float(new_prop["price"]) - float(old_prop["price"]))
-        price_score = max(0.0, 1.0 - diff / max(float(new_prop["price"]), float(old_prop["price"]), 1.0))
-
-    total = (
-        image_score * 0.35
-        + loc_score * 0.25
-        + specifics_score * 0.25
-        + price_score * 0.15
-    )
-    return round(total * 100.0, 2)
+    scores: list[float] = []
+    for old_prop, distance in zip(candidates, distances):
+        image_score = 0.0
+        old_img = normalize_text(old_prop["image_url"])
+        if new_img and old_img:
+            if new_img == old_img:
+                image_score = 1.0
+            else:
+                image_score = max(
+                    normalized_similarity(new_img_base, normalize_text(os.path.basename(old_img))) * 0.8,
+                    normalized_similarity(new_img, old_img) * 0.5,
+                )
+
+        loc_score = normalized_similarity(new_loc, normalize_text(old_prop["location_text"]))
+        if distance is not None:
+            geo_score = 1.0 if distance <= 60 else max(0.0, 1.0 - (distance / 4000.0))
+            loc_score = max(loc_score, geo_score)
+
+        type_score = 1.0 if new_type == normalize_text(old_prop["asset_type"]) else 0.0
+        config_score = normalized_similarity(new_config, normalize_text(old_prop["configuration"]))
+
+        area_score = 0.0
+        if new_area is not None and old_prop["area_value"]:
+            old_area = float(old_prop["area_value"])
+            area_score = max(0.0, 1.0 - abs(new_area - old_area) / max(new_area, old_area, 1.0))
+        specifics_score = (type_score * 0.45) + (config_score * 0.4) + (area_score * 0.15)
+
+        price_score = 0.0
+        if new_price is not None and old_prop["price"]:
+            old_price = float(old_prop["price"])
+            price_score = max(0.0, 1.0 - abs(new_price - old_price) / max(new_price, old_price, 1.0))
+
+        total = (
+            image_score * 0.35
+            + loc_score * 0.25
+            + specifics_score * 0.25
+            + price_score * 0.15
+        )
+        scores.append(round(total * 100.0, 2))
+    return scores
 
 
-def run_duplicate_checks(conn: sqlite3.Connection, property_id: int) -> dict:
-    prop = conn.execute("SELECT * FROM properties WHERE id = ?", (property_id,)).fetchone()
+def run_duplicate_checks(
+    conn: sqlite3.Connection,
+    property_id: int,
+    prop: sqlite3.Row | None = None,
+    now: datetime | None = None,
+) -> dict:
+    if prop is None:
+        prop = conn.execute("SELECT * FROM properties WHERE id = ?", (property_id,)).fetchone()
     if not prop:
         return {"matched": False}
 
-    candidates = conn.execute(
-        """
-        SELECT *
-        FROM properties
-        WHERE id != ?
-          AND city = ?
-          AND status IN (?, ?, ?, ?)
-        """,
-        (
-            property_id,
-            prop["city"],
-            PROPERTY_STATUS_ACTIVE,
-            PROPERTY_STATUS_BACKUP,
-            PROPERTY_STATUS_HIDDEN_DUPLICATE,
-            PROPERTY_STATUS_SOLD,
-        ),
-    ).fetchall()
+    candidates: list[sqlite3.Row] = []
+    if normalize_text(prop["image_url"]):
+        candidates = conn.execute(
+            """
+            SELECT *
+            FROM properties
+            WHERE id != ?
+              AND city = ?
+              AND status IN (?, ?, ?, ?)
+              AND image_url IS NOT NULL
+              AND image_url != ''
+            """,
+            (
+                property_id,
+                prop["city"],
+                PROPERTY_STATUS_ACTIVE,
+                PROPERTY_STATUS_BACKUP,
+                PROPERTY_STATUS_HIDDEN_DUPLICATE,
+                PROPERTY_STATUS_SOLD,
+            ),
+        ).fetchall()
 
     best = None
     best_score = 0.0
-    for candidate in candidates:
-        score = compute_similarity(prop, candidate)
+    for candidate, score in zip(candidates, compute_similarity_batch(prop, candidates)):
         if score > best_score:
             best_score = score
             best = candidate
 
     if not best or best_score <= 75.0:
-        conn.execute(
-            """
-            UPDATE properties
-            SET status = ?, hidden_from_customers = 0, duplicate_score = NULL, updated_at = ?
-            WHERE id = ?
-            """,
-            (PROPERTY_STATUS_ACTIVE, to_iso(now_local()), property_id),
-        )
+        if (prop["status"], prop["hidden_from_customers"], prop["duplicate_score"]) != (PROPERTY_STATUS_ACTIVE, 0, None):
+            conn.execute(
+                """
+                UPDATE properties
+                SET status = ?, hidden_from_customers = 0, duplicate_score = NULL, updated_at = ?
+                WHERE id = ?
+                """,
+                (PROPERTY_STATUS_ACTIVE, to_iso(now or now_local()), property_id),
+            )
         return {"matched": False, "score": best_score}
 
     auto_hidden = 1 if best_score > 95.0 else 0
-    now = to_iso(now_local())
+    now = to_iso(now or now_local())
 
     older = best if parse_iso(best["created_at"]) <= parse_iso(prop["created_at"]) else prop
     primary_property_id = older["id"]
@@ -1340,97 +2064,131 @@ def require_role(user: sqlite3.Row, allowed: list[str]) -> bool:
 
 
 def parse_query(path: str) -> dict:
-    return {k: v[0] for k, v in parse_qs(urlparse(path).query).items()}
+    query = path.partition("#")[0].partition("?")[2]
+    params: dict[str, str] = {}
+    if not query:
+        return params
+    for pair in query.split("&"):
+        key, sep, value = pair.partition("=")
+        if not sep or not value:
+            continue
+        key = unquote_plus(key)
+        if key not in params:
+            params[key] = unquote_plus(value)
+    return params
+
+
+def batched(items: Iterable, size: int) -> Iterator[list]:
+    batch: list = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_lead_import_rows(fp: TextIO, now: str) -> Iterator[tuple[tuple, tuple]]:
+    for row in csv.DictReader(fp):
+        phone = normalize_phone(row.get("phone"))
+        if not phone:
+            continue
+        customer = (row.get("name") or "", phone, now)
+        lead = (
+            row.get("city") or "",
+            row.get("location_pref") or "",
+            row.get("config_pref") or "",
+            float(row.get("budget_min") or 0),
+            float(row.get("budget_max") or 0),
+            row.get("requirement_text") or "",
+            "excel_sync",
+            now,
+            now,
+            phone,
+        )
+        yield customer, lead
+
+
+_lead_import_lock = threading.Lock()
 
 
 def import_leads_from_csv() -> dict:
     if not LEADS_IMPORT_FILE.exists():
         return {"imported": 0, "updated": 0, "status": "file_not_found"}
 
-    imported = 0
-    updated = 0
+    processed = 0
     now = to_iso(now_local())
 
-    with connect_db() as conn:
-        with LEADS_IMPORT_FILE.open("r", encoding="utf-8") as fp:
-            reader = csv.DictReader(fp)
-            for row in reader:
-                phone = normalize_phone(row.get("phone"))
-                if not phone:
-                    continue
-
-                customer = conn.execute(
-                    "SELECT id FROM customers WHERE phone_norm = ?", (phone,)
-                ).fetchone()
-                if not customer:
-                    conn.execute(
-                        "INSERT INTO customers(name, phone_norm, created_at) VALUES(?, ?, ?)",
-                        (row.get("name") or "", phone, now),
-                    )
-                    customer_id = conn.execute("SELECT last_insert_rowid() AS id").fetchone()["id"]
-                else:
-                    customer_id = customer["id"]
-                    if row.get("name"):
-                        conn.execute(
-                            "UPDATE customers SET name = ? WHERE id = ?",
-                            (row.get("name"), customer_id),
-                        )
-
-                payload = (
-                    customer_id,
-                    row.get("city") or "",
-                    row.get("location_pref") or "",
-                    row.get("config_pref") or "",
-                    float(row.get("budget_min") or 0),
-                    float(row.get("budget_max") or 0),
-                    row.get("requirement_text") or "",
-                    "excel_sync",
-                    now,
-                    now,
+    with _lead_import_lock:
+        lead_count_before = connect_db_readonly().execute("SELECT COUNT(*) AS c FROM leads").fetchone()["c"]
+        with LEADS_IMPORT_FILE.open("r", encoding="utf-8", newline="") as fp:
+            for chunk in batched(iter_lead_import_rows(fp, now), LEAD_IMPORT_BATCH_SIZE):
+                conn = connect_db()
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany(
+                    """
+                    INSERT INTO customers(name, phone_norm, created_at)
+                    VALUES(?, ?, ?)
+                    ON CONFLICT(phone_norm) DO UPDATE SET name = excluded.name
+                    WHERE excluded.name != '' AND excluded.name IS NOT customers.name
+                    """,
+                    [customer for customer, _ in chunk],
                 )
-
-                exists = conn.execute(
+                conn.executemany(
                     """
-                    SELECT id
-                    FROM leads
-                    WHERE customer_id = ?
-                      AND city = ?
-                      AND location_pref = ?
-                      AND config_pref = ?
-                      AND budget_min = ?
-                      AND budget_max = ?
+                    INSERT INTO leads(
+                        customer_id, city, location_pref, config_pref, budget_min, budget_max,
+                        requirement_text, source, last_synced_at, created_at
+                    )
+                    SELECT id, ?, ?, ?, ?, ?, ?, ?, ?, ?
+                    FROM customers
+                    WHERE phone_norm = ?
+                    ON CONFLICT(customer_id, city, location_pref, config_pref, budget_min, budget_max) DO UPDATE SET
+                        requirement_text = excluded.requirement_text,
+                        source = excluded.source,
+                        last_synced_at = excluded.last_synced_at
                     """,
-                    payload[:6],
-                ).fetchone()
+                    [lead for _, lead in chunk],
+                )
+                conn.commit()
+                release_db()
+                processed += len(chunk)
+        lead_count_after = connect_db_readonly().execute("SELECT COUNT(*) AS c FROM leads").fetchone()["c"]
 
-                if exists:
-                    conn.execute(
-                        """
-                        UPDATE leads
-                        SET requirement_text = ?, source = ?, last_synced_at = ?
-                        WHERE id = ?
-                        """,
-                        (payload[6], payload[7], payload[8], exists["id"]),
-                    )
-                    updated += 1
-                else:
-                    conn.execute(
-                        """
-                        INSERT INTO leads(
-                            customer_id, city, location_pref, config_pref, budget_min, budget_max,
-                            requirement_text, source, last_synced_at, created_at
-                        ) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                        """,
-                        payload,
-                    )
-                    imported += 1
+    imported = lead_count_after - lead_count_before
+    return {"imported": imported, "updated": processed - imported, "status": "ok"}
 
-        conn.commit()
 
-    return {"imported": imported, "updated": updated, "status": "ok"}
+def lead_import_file_signature() -> tuple[int, int] | None:
+    try:
+        stat_result = LEADS_IMPORT_FILE.stat()
+    except OSError:
+        return None
+    return stat_result.st_mtime_ns, stat_result.st_size
 
 
-class LeadSyncThread(threading.Thread):
+def run_lead_import() -> dict:
+    try:
+        return import_leads_from_csv()
+    finally:
+        release_db()
+
+
+def run_maintenance() -> None:
+    try:
+        with connect_db() as conn:
+            now = now_local()
+            decay_flags(conn, now)
+            process_incident_escalations(conn, now)
+        if db_has_changes():
+            invalidate_dashboard_cache()
+            bump_write_generation()
+    finally:
+        release_db()
+
+
+class MaintenanceThread(threading.Thread):
     daemon = True
 
     def __init__(self, stop_event: threading.Event):
@@ -1440,36 +2198,255 @@ class LeadSyncThread(threading.Thread):
     def run(self) -> None:
         while not self.stop_event.is_set():
             try:
-                import_leads_from_csv()
+                run_maintenance()
             except Exception as exc:
-                print(f"[lead-sync] error: {exc}")
+                print(f"[maintenance] error: {exc}")
+            self.stop_event.wait(MAINTENANCE_INTERVAL_SECONDS)
+
+
+class LeadSyncThread(threading.Thread):
+    daemon = True
+
+    def __init__(self, stop_event: threading.Event):
+        super().__init__()
+        self.stop_event = stop_event
+
+    def run(self) -> None:
+        last_signature = None
+        while not self.stop_event.is_set():
+            signature = lead_import_file_signature()
+            if signature is not None and signature != last_signature:
+                try:
+                    run_lead_import()
+                    last_signature = signature
+                except Exception as exc:
+                    print(f"[lead-sync] error: {exc}")
             self.stop_event.wait(LEAD_SYNC_INTERVAL_SECONDS)
 
 
+_lead_import_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lead-import")
+_lead_import_jobs: OrderedDict[str, Future] = OrderedDict()
+_lead_import_jobs_lock = threading.Lock()
+
+
+def submit_lead_import() -> str:
+    job_id = secrets.token_hex(8)
+    future = _lead_import_executor.submit(run_lead_import)
+    with _lead_import_jobs_lock:
+        _lead_import_jobs[job_id] = future
+        while len(_lead_import_jobs) > LEAD_IMPORT_JOBS_MAX:
+            _lead_import_jobs.popitem(last=False)
+    return job_id
+
+
+def lead_import_status(job_id: str) -> dict | None:
+    future = _lead_import_jobs.get(job_id)
+    if future is None:
+        return None
+    if not future.done():
+        return {"job_id": job_id, "status": "running" if future.running() else "queued"}
+    exc = future.exception()
+    if exc is not None:
+        return {"job_id": job_id, "status": "error", "error": str(exc)}
+    return {"job_id": job_id, "status": "done", "result": future.result()}
+
+
+_static_cache: dict[Path, tuple[str, bytes]] = {}
+_static_cache_lock = threading.Lock()
+
+
+_auth_cache: OrderedDict[str, tuple[sqlite3.Row, datetime]] = OrderedDict()
+_auth_cache_lock = threading.Lock()
+
+
+def get_cached_auth_user(token: str, now: datetime) -> sqlite3.Row | None:
+    with _auth_cache_lock:
+        cached = _auth_cache.get(token)
+        if cached is None:
+            return None
+        user, valid_until = cached
+        if valid_until <= now:
+            del _auth_cache[token]
+            return None
+        _auth_cache.move_to_end(token)
+        return user
+
+
+def cache_auth_user(token: str, user: sqlite3.Row, expires_at: datetime, now: datetime) -> None:
+    valid_until = min(expires_at, now + timedelta(seconds=AUTH_CACHE_TTL_SECONDS))
+    with _auth_cache_lock:
+        _auth_cache[token] = (user, valid_until)
+        _auth_cache.move_to_end(token)
+        while len(_auth_cache) > AUTH_CACHE_MAX_ENTRIES:
+            _auth_cache.popitem(last=False)
+
+
+def invalidate_auth_cache(user_id: int) -> None:
+    with _auth_cache_lock:
+        for token in [token for token, (user, _) in _auth_cache.items() if user["id"] == user_id]:
+            del _auth_cache[token]
+
+
+_dashboard_cache: dict[tuple[int, str], tuple[float, dict]] = {}
+_dashboard_cache_lock = threading.Lock()
+
+
+def get_cached_dashboard_metrics(key: tuple[int, str]) -> dict | None:
+    cached = _dashboard_cache.get(key)
+    if cached is None or time.monotonic() - cached[0] >= DASHBOARD_CACHE_TTL_SECONDS:
+        return None
+    return cached[1]
+
+
+def cache_dashboard_metrics(key: tuple[int, str], metrics: dict) -> None:
+    with _dashboard_cache_lock:
+        _dashboard_cache[key] = (time.monotonic(), metrics)
+
+
+def invalidate_dashboard_cache() -> None:
+    with _dashboard_cache_lock:
+        _dashboard_cache.clear()
+
+
+_etag_key = secrets.token_bytes(16)
+_write_generation = 0
+_write_generation_lock = threading.Lock()
+
+
+def bump_write_generation() -> None:
+    global _write_generation
+    with _write_generation_lock:
+        _write_generation += 1
+
+
+def compute_etag(*parts) -> str:
+    digest = hashlib.blake2b(repr(parts).encode("utf-8"), digest_size=8, key=_etag_key).hexdigest()
+    return f'"{digest}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [value.strip().removeprefix("W/") for value in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+_assigned_brokers_cache: dict[int, tuple[float, tuple[int, ...], str]] = {}
+_assigned_brokers_cache_lock = threading.Lock()
+
+
+def invalidate_assigned_brokers_cache() -> None:
+    with _assigned_brokers_cache_lock:
+        _assigned_brokers_cache.clear()
+
+
+class StreamWriter(io.RawIOBase):
+    def __init__(self, wfile: io.BufferedIOBase, chunked: bool):
+        super().__init__()
+        self.wfile = wfile
+        self.chunked = chunked
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        size = len(data)
+        if not self.chunked:
+            self.wfile.write(data)
+        elif size:
+            self.wfile.write(b"%x\r\n%b\r\n" % (size, data))
+        return size
+
+    def finish(self) -> None:
+        if self.chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
+
 class AppHandler(BaseHTTPRequestHandler):
     server_version = "ProptechMVP/1.0"
+    protocol_version = "HTTP/1.1"
+    timeout = HTTP_KEEPALIVE_TIMEOUT_SECONDS
+    disable_nagle_algorithm = True
+    request_body = b""
 
-    def _send_json(self, status: int, payload: dict) -> None:
-        body = json.dumps(payload).encode("utf-8")
+    def _send_json(self, status: int, payload: dict, etag: str | None = None) -> None:
+        self._send_json_body(status, PAYLOAD_JSON_ENCODER.encode(payload).encode("ascii"), etag)
+
+    def _send_json_body(self, status: int, body: bytes, etag: str | None = None) -> None:
         self.send_response(status)
         self.send_header("Content-Type", "application/json; charset=utf-8")
         self.send_header("Content-Length", str(len(body)))
-        self.send_header("Cache-Control", "no-store")
+        self._send_cache_headers(etag)
         self.end_headers()
         self.wfile.write(body)
 
-    def _send_csv(self, filename: str, csv_payload: str) -> None:
-        body = csv_payload.encode("utf-8")
+    def _send_cache_headers(self, etag: str | None) -> None:
+        if etag is None:
+            self.send_header("Cache-Control", "no-store")
+            return
+        self.send_header("Cache-Control", "private, no-cache")
+        self.send_header("ETag", etag)
+
+    def _send_not_modified(self, etag: str) -> bool:
+        if not etag_matches(self.headers.get("If-None-Match"), etag):
+            return False
+        self.send_response(HTTPStatus.NOT_MODIFIED)
+        self._send_cache_headers(etag)
+        self.end_headers()
+        return True
+
+    def _begin_stream(self) -> StreamWriter:
+        if self.request_version == "HTTP/1.0":
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            return StreamWriter(self.wfile, chunked=False)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        return StreamWriter(self.wfile, chunked=True)
+
+    def _send_json_items(self, cursor: sqlite3.Cursor, etag: str | None = None) -> None:
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self._send_cache_headers(etag)
+        out = self._begin_stream()
+        encode = PAYLOAD_JSON_ENCODER.encode
+        names = [column[0] for column in cursor.description]
+        cursor.row_factory = None
+        parts = ['{"ok":true,"items":[']
+        buffered = 0
+        for index, values in enumerate(cursor):
+            item = encode(dict(zip(names, values)))
+            parts.append("," + item if index else item)
+            buffered += len(item)
+            if buffered >= JSON_STREAM_CHUNK_BYTES:
+                out.write("".join(parts).encode("ascii"))
+                parts.clear()
+                buffered = 0
+        parts.append("]}")
+        out.write("".join(parts).encode("ascii"))
+        out.finish()
+
+    def _send_csv(self, filename: str, headers: list[str], rows: Iterable[Iterable]) -> None:
         self.send_response(HTTPStatus.OK)
         self.send_header("Content-Type", "text/csv; charset=utf-8")
-        self.send_header("Content-Length", str(len(body)))
         self.send_header("Content-Disposition", f'attachment; filename="{filename}"')
         self.send_header("Cache-Control", "no-store")
-        self.end_headers()
-        self.wfile.write(body)
+        stream = self._begin_stream()
+        out = io.TextIOWrapper(io.BufferedWriter(stream, JSON_STREAM_CHUNK_BYTES), encoding="utf-8", newline="")
+        try:
+            write_csv(out, headers, rows)
+            out.flush()
+        finally:
+            out.detach()
+        stream.finish()
 
     def _send_file(self, file_path: Path) -> None:
-        if not file_path.exists() or not file_path.is_file():
+        try:
+            stat_result = file_path.stat()
+        except OSError:
+            stat_result = None
+        if stat_result is None or not stat.S_ISREG(stat_result.st_mode):
             self.send_error(HTTPStatus.NOT_FOUND, "Not Found")
             return
 
@@ -1483,14 +2460,38 @@ class AppHandler(BaseHTTPRequestHandler):
         elif file_path.suffix == ".json":
             mime = "application/json; charset=utf-8"
 
-        data = file_path.read_bytes()
+        size = stat_result.st_size
+        etag = f'"{stat_result.st_mtime_ns:x}-{size:x}"'
+        if etag_matches(self.headers.get("If-None-Match"), etag):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        data = None
+        if size <= STATIC_CACHE_MAX_BYTES:
+            cached = _static_cache.get(file_path)
+            if cached is not None and cached[0] == etag:
+                data = cached[1]
+            else:
+                data = file_path.read_bytes()
+                with _static_cache_lock:
+                    _static_cache[file_path] = (etag, data)
+            size = len(data)
+
         self.send_response(HTTPStatus.OK)
         self.send_header("Content-Type", mime)
-        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Content-Length", str(size))
+        self.send_header("ETag", etag)
         self.end_headers()
-        self.wfile.write(data)
+        if data is not None:
+            self.wfile.write(data)
+            return
+        with file_path.open("rb") as fp:
+            self.wfile.flush()
+            self.connection.sendfile(fp, 0, size)
 
-    def _auth_user(self) -> sqlite3.Row | None:
+    def _auth_user(self, now: datetime | None = None) -> sqlite3.Row | None:
         auth_header = self.headers.get("Authorization", "")
         if not auth_header.startswith("Bearer "):
             return None
@@ -1498,23 +2499,23 @@ class AppHandler(BaseHTTPRequestHandler):
         if not token:
             return None
 
-        with connect_db() as conn:
-            row = conn.execute(
-                """
-                SELECT u.*
-                FROM sessions s
-                JOIN users u ON u.id = s.user_id
-                WHERE s.token = ? AND s.expires_at > ?
-                """,
-                (token, to_iso(now_local())),
-            ).fetchone()
-            return row
+        now = now or now_local()
+        user = get_cached_auth_user(token, now)
+        if user is not None:
+            return user
 
-    def _maintenance(self) -> None:
-        with connect_db() as conn:
-            decay_flags(conn)
-            process_incident_escalations(conn)
-            conn.commit()
+        row = connect_db_readonly().execute(
+            """
+            SELECT u.id, u.name, u.email, u.role, u.city, u.active, s.expires_at AS session_expires_at
+            FROM sessions s
+            JOIN users u ON u.id = s.user_id
+            WHERE s.token = ? AND s.expires_at > ?
+            """,
+            (token, to_iso(now)),
+        ).fetchone()
+        if row is not None:
+            cache_auth_user(token, row, parse_iso(row["session_expires_at"]), now)
+        return row
 
     def do_OPTIONS(self):
         self.send_response(204)
@@ -1526,7 +2527,10 @@ class AppHandler(BaseHTTPRequestHandler):
     def do_GET(self):
         path = urlparse(self.path).path
         if path.startswith("/api/"):
-            self.handle_api("GET")
+            try:
+                self.handle_api("GET")
+            finally:
+                release_db()
             return
 
         if path == "/" or path == "":
@@ -1543,758 +2547,646 @@ class AppHandler(BaseHTTPRequestHandler):
     def do_POST(self):
         path = urlparse(self.path).path
         if path.startswith("/api/"):
-            self.handle_api("POST")
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > MAX_REQUEST_BODY_BYTES:
+                self.close_connection = True
+                self._send_json(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"ok": False, "error": "Request body too large"})
+                return
+            self.request_body = self.rfile.read(length) if length > 0 else b""
+            try:
+                self.handle_api("POST")
+            finally:
+                release_db()
             return
         self.send_error(HTTPStatus.NOT_FOUND, "Not Found")
 
     def _unauthorized(self):
-        self._send_json(HTTPStatus.UNAUTHORIZED, {"ok": False, "error": "Unauthorized"})
+        self._send_json_body(HTTPStatus.UNAUTHORIZED, UNAUTHORIZED_JSON_BODY)
 
     def _forbidden(self):
-        self._send_json(HTTPStatus.FORBIDDEN, {"ok": False, "error": "Forbidden"})
+        self._send_json_body(HTTPStatus.FORBIDDEN, FORBIDDEN_JSON_BODY)
 
     def handle_api(self, method: str) -> None:
-        self._maintenance()
+        try:
+            self._dispatch_api(method)
+        finally:
+            if db_has_changes():
+                invalidate_dashboard_cache()
+                bump_write_generation()
+
+    def _dispatch_api(self, method: str) -> None:
+        now_dt = now_local()
+        now_iso = to_iso(now_dt)
         path = urlparse(self.path).path
         query = parse_query(self.path)
 
-        if method == "GET" and path == "/api/health":
-            self._send_json(HTTPStatus.OK, {"ok": True, "service": "proptech-mvp", "time": to_iso(now_local())})
+        route = self.PUBLIC_API_ROUTES.get((method, path))
+        if route is not None:
+            route(self, None, query, now_dt, now_iso)
             return
 
-        if method == "GET" and path == "/api/scheduling/duration":
-            property_count = int(query.get("property_count") or 1)
-            duration = calculate_tour_duration_minutes(property_count)
-            self._send_json(
-                HTTPStatus.OK,
-                {
-                    "ok": True,
-                    "property_count": max(1, property_count),
-                    "total_duration_minutes": duration,
-                    "rule": "First property = 120 mins, each additional property = 45 mins",
-                },
-            )
+        user = self._auth_user(now_dt)
+        if not user:
+            self._unauthorized()
             return
 
-        if method == "GET" and path == "/api/customer/visits":
-            customer_phone = normalize_phone(query.get("phone"))
-            if not customer_phone:
-                self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "phone query is required"})
-                return
-            with connect_db() as conn:
-                rows = conn.execute(
-                    """
-                    SELECT
-                        v.*,
-                        p.title AS property_title,
-                        p.location_text,
-                        b.name AS broker_name,
-                        c.phone_norm
-                    FROM visits v
-                    JOIN customers c ON c.id = v.customer_id
-                    JOIN properties p ON p.id = v.property_id
-                    JOIN users b ON b.id = v.broker_id
-                    WHERE c.phone_norm = ?
-                      AND v.status = ?
-                    ORDER BY v.start_at ASC
-                    """,
-                    (customer_phone, VISIT_STATUS_SCHEDULED),
-                ).fetchall()
-
-                items = []
-                for row in rows:
-                    item = dict(row)
-                    item["available_slots"] = get_rebooking_slots_for_visit(conn, row)
-                    items.append(item)
-            self._send_json(HTTPStatus.OK, {"ok": True, "items": items})
+        route = self.API_ROUTES.get((method, path))
+        if route is None:
+            self._send_json_body(HTTPStatus.NOT_FOUND, ROUTE_NOT_FOUND_JSON_BODY)
             return
+        route(self, user, query, now_dt, now_iso)
 
-        if method == "POST" and path == "/api/customer/visits/cancel":
-            data = parse_request_body(self)
-            visit_id = int(data.get("visit_id") or 0)
-            customer_phone = normalize_phone(data.get("customer_phone"))
-            reason = (data.get("reason") or "customer_requested").strip()
-            if not visit_id or not customer_phone:
-                self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "visit_id and customer_phone are required"})
-                return
-            with connect_db() as conn:
-                try:
-                    result = cancel_visit_by_customer(
-                        conn,
-                        visit_id=visit_id,
-                        customer_phone=customer_phone,
-                        reason=reason,
-                        source="customer_self_service",
-                    )
-                except ValueError as exc:
-                    self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": str(exc)})
-                    return
-                conn.commit()
-            self._send_json(HTTPStatus.OK, {"ok": True, "result": result})
+    def _get_health(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        self._send_json(HTTPStatus.OK, {"ok": True, "service": "proptech-mvp", "time": now_iso})
+
+    def _get_scheduling_duration(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        property_count = int(query.get("property_count") or 1)
+        duration = calculate_tour_duration_minutes(property_count)
+        self._send_json(
+            HTTPStatus.OK,
+            {
+                "ok": True,
+                "property_count": max(1, property_count),
+                "total_duration_minutes": duration,
+                "rule": "First property = 120 mins, each additional property = 45 mins",
+            },
+        )
+
+    def _get_customer_visits(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        customer_phone = normalize_phone(query.get("phone"))
+        if not customer_phone:
+            self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "phone query is required"})
             return
+        with connect_db_readonly() as conn:
+            rows = conn.execute(
+                f"""
+                SELECT
+                    {VISIT_COLUMNS},
+                    p.title AS property_title,
+                    p.location_text,
+                    b.name AS broker_name,
+                    c.phone_norm
+                FROM visits v
+                JOIN customers c ON c.id = v.customer_id
+                JOIN properties p ON p.id = v.property_id
+                JOIN users b ON b.id = v.broker_id
+                WHERE c.phone_norm = ?
+                  AND v.status = ?
+                ORDER BY v.start_at ASC
+                """,
+                (customer_phone, VISIT_STATUS_SCHEDULED),
+            ).fetchall()
 
-        if method == "POST" and path == "/api/customer/visits/reschedule":
-            data = parse_request_body(self)
-            visit_id = int(data.get("visit_id") or 0)
-            target_slot_id = int(data.get("target_slot_id") or 0)
-            customer_phone = normalize_phone(data.get("customer_phone"))
-            reason = (data.get("reason") or "customer_requested").strip()
-            if not visit_id or not target_slot_id or not customer_phone:
-                self._send_json(
-                    HTTPStatus.BAD_REQUEST,
-                    {"ok": False, "error": "visit_id, target_slot_id, customer_phone are required"},
+            slots_by_visit = get_rebooking_slots_for_visits(conn, rows, now_dt)
+            items = []
+            for row in rows:
+                item = dict(row)
+                item["available_slots"] = slots_by_visit[row["id"]]
+                items.append(item)
+        self._send_json(HTTPStatus.OK, {"ok": True, "items": items})
+
+    def _post_customer_visits_cancel(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        data = parse_request_body(self)
+        visit_id = int(data.get("visit_id") or 0)
+        customer_phone = normalize_phone(data.get("customer_phone"))
+        reason = (data.get("reason") or "customer_requested").strip()
+        if not visit_id or not customer_phone:
+            self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "visit_id and customer_phone are required"})
+            return
+        with connect_db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = cancel_visit_by_customer(
+                    conn,
+                    visit_id=visit_id,
+                    customer_phone=customer_phone,
+                    reason=reason,
+                    source="customer_self_service",
+                    now=now_dt,
                 )
+            except ValueError as exc:
+                conn.rollback()
+                self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": str(exc)})
                 return
-            with connect_db() as conn:
-                try:
-                    result = reschedule_visit_by_customer(
-                        conn,
-                        visit_id=visit_id,
-                        customer_phone=customer_phone,
-                        target_slot_id=target_slot_id,
-                        reason=reason,
-                        source="customer_self_service",
-                    )
-                except ValueError as exc:
-                    self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": str(exc)})
-                    return
-                conn.commit()
-            self._send_json(HTTPStatus.OK, {"ok": True, "result": result})
-            return
-
-        if method == "POST" and path == "/api/integrations/whatsapp/webhook":
-            data = parse_request_body(self)
-            event_type = (data.get("event_type") or "unknown").strip().lower()
-            from_phone = normalize_phone(data.get("from_phone"))
-            message_text = (data.get("message_text") or "").strip()
-
-            with connect_db() as conn:
-                webhook_id = log_whatsapp_webhook_event(conn, event_type, from_phone, data)
-                queue_whatsapp_message(
+            conn.commit()
+        self._send_json(HTTPStatus.OK, {"ok": True, "result": result})
+
+    def _post_customer_visits_reschedule(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        data = parse_request_body(self)
+        visit_id = int(data.get("visit_id") or 0)
+        target_slot_id = int(data.get("target_slot_id") or 0)
+        customer_phone = normalize_phone(data.get("customer_phone"))
+        reason = (data.get("reason") or "customer_requested").strip()
+        if not visit_id or not target_slot_id or not customer_phone:
+            self._send_json(
+                HTTPStatus.BAD_REQUEST,
+                {"ok": False, "error": "visit_id, target_slot_id, customer_phone are required"},
+            )
+            return
+        with connect_db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = reschedule_visit_by_customer(
                     conn,
-                    direction="inbound",
-                    source="whatsapp_webhook",
-                    to_phone=None,
-                    from_phone=from_phone,
-                    template_name=None,
-                    language=WHATSAPP_LANG,
-                    message_text=message_text,
-                    payload=data,
-                    status="received",
-                    related_visit_id=None,
+                    visit_id=visit_id,
+                    customer_phone=customer_phone,
+                    target_slot_id=target_slot_id,
+                    reason=reason,
+                    source="customer_self_service",
+                    now=now_dt,
                 )
+            except ValueError as exc:
+                conn.rollback()
+                self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": str(exc)})
+                return
+            conn.commit()
+        self._send_json(HTTPStatus.OK, {"ok": True, "result": result})
 
-                command_result = {"action": "logged"}
-                if event_type == "message_received" and from_phone and message_text:
-                    upper = message_text.strip().upper()
-                    cancel_match = re.match(r"^CANCEL\\s+(\\d+)$", upper)
-                    reschedule_match = re.match(r"^RESCHEDULE\\s+(\\d+)\\s+(\\d+)$", upper)
-                    if upper == "HELP":
-                        send_whatsapp_template(
-                            conn,
-                            to_phone=from_phone,
-                            template_name="customer_help",
-                            context={},
-                            source="whatsapp_webhook",
-                        )
-                        command_result = {"action": "help_sent"}
-                    elif cancel_match:
-                        try:
-                            result = cancel_visit_by_customer(
-                                conn,
-                                visit_id=int(cancel_match.group(1)),
-                                customer_phone=from_phone,
-                                reason="customer_whatsapp_cancel",
-                                source="whatsapp_webhook",
-                            )
-                            command_result = {"action": "visit_cancelled", "result": result}
-                        except ValueError as exc:
-                            send_whatsapp_template(
-                                conn,
-                                to_phone=from_phone,
-                                template_name="customer_help",
-                                context={"message": str(exc)},
-                                source="whatsapp_webhook",
-                            )
-                            command_result = {"action": "cancel_failed", "error": str(exc)}
-                    elif reschedule_match:
-                        try:
-                            result = reschedule_visit_by_customer(
-                                conn,
-                                visit_id=int(reschedule_match.group(1)),
-                                customer_phone=from_phone,
-                                target_slot_id=int(reschedule_match.group(2)),
-                                reason="customer_whatsapp_reschedule",
-                                source="whatsapp_webhook",
-                            )
-                            command_result = {"action": "visit_rescheduled", "result": result}
-                        except ValueError as exc:
-                            send_whatsapp_template(
-                                conn,
-                                to_phone=from_phone,
-                                template_name="customer_help",
-                                context={"message": str(exc)},
-                                source="whatsapp_webhook",
-                            )
-                            command_result = {"action": "reschedule_failed", "error": str(exc)}
-                    else:
-                        send_whatsapp_template(
-                            conn,
-                            to_phone=from_phone,
-                            template_name="customer_help",
-                            context={},
-                            source="whatsapp_webhook",
-                        )
-                        command_result = {"action": "unknown_command_help_sent"}
+    def _post_integrations_whatsapp_webhook(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        data = parse_request_body(self)
+        event_type = (data.get("event_type") or "unknown").strip().lower()
+        from_phone = normalize_phone(data.get("from_phone"))
+        message_text = (data.get("message_text") or "").strip()
+        provider_message_id = str(data.get("provider_message_id") or "").strip() or None
 
-                conn.commit()
-            self._send_json(
-                HTTPStatus.OK,
-                {"ok": True, "webhook_event_id": webhook_id, "result": command_result},
+        with connect_db() as conn:
+            webhook_id = log_whatsapp_webhook_event(conn, event_type, from_phone, data, provider_message_id, now_iso)
+            if webhook_id is None:
+                self._send_json(HTTPStatus.OK, {"ok": True, "duplicate": True})
+                return
+            queue_whatsapp_message(
+                conn,
+                direction="inbound",
+                source="whatsapp_webhook",
+                to_phone=None,
+                from_phone=from_phone,
+                template_name=None,
+                language=WHATSAPP_LANG,
+                message_text=message_text,
+                payload=data,
+                status="received",
+                related_visit_id=None,
+                created_at=now_iso,
             )
-            return
 
-        if method == "POST" and path == "/api/auth/login":
-            data = parse_request_body(self)
-            email = (data.get("email") or "").strip().lower()
-            password = data.get("password") or ""
+            command_result = {"action": "logged"}
+            if event_type == "message_received" and from_phone and message_text:
+                command_result = handle_whatsapp_command(conn, from_phone, message_text, now_dt)
 
-            with connect_db() as conn:
-                user = conn.execute(
-                    "SELECT * FROM users WHERE email = ?",
-                    (email,),
-                ).fetchone()
-                if not user or user["password_hash"] != hash_password(password):
-                    self._send_json(HTTPStatus.UNAUTHORIZED, {"ok": False, "error": "Invalid credentials"})
-                    return
-                if user["active"] == 0:
-                    self._send_json(HTTPStatus.FORBIDDEN, {"ok": False, "error": "Broker removed after 3 flags"})
-                    return
+            conn.commit()
+        self._send_json(
+            HTTPStatus.OK,
+            {"ok": True, "webhook_event_id": webhook_id, "result": command_result},
+        )
 
-                token = secrets.token_hex(24)
-                expires_at = now_local() + timedelta(hours=SESSION_HOURS)
+    def _post_auth_login(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        data = parse_request_body(self)
+        email = (data.get("email") or "").strip().lower()
+        password = data.get("password") or ""
+
+        user = connect_db_readonly().execute(
+            "SELECT id, name, email, role, city, active, password_hash FROM users WHERE email = ?",
+            (email,),
+        ).fetchone()
+        password_ok = verify_password(password, user["password_hash"] if user else DUMMY_PASSWORD_HASH)
+        if not user or not password_ok:
+            self._send_json(HTTPStatus.UNAUTHORIZED, {"ok": False, "error": "Invalid credentials"})
+            return
+        if user["active"] == 0:
+            self._send_json(HTTPStatus.FORBIDDEN, {"ok": False, "error": "Broker removed after 3 flags"})
+            return
+
+        rehashed = hash_password(password) if password_needs_rehash(user["password_hash"]) else None
+        token = secrets.token_hex(24)
+        expires_at = now_dt + timedelta(hours=SESSION_HOURS)
+        with connect_db() as conn:
+            if rehashed is not None:
                 conn.execute(
-                    "INSERT INTO sessions(user_id, token, expires_at, created_at) VALUES(?, ?, ?, ?)",
-                    (user["id"], token, to_iso(expires_at), to_iso(now_local())),
+                    "UPDATE users SET password_hash = ? WHERE id = ?",
+                    (rehashed, user["id"]),
                 )
-                conn.commit()
-
-            self._send_json(
-                HTTPStatus.OK,
-                {
-                    "ok": True,
-                    "token": token,
-                    "user": {
-                        "id": user["id"],
-                        "name": user["name"],
-                        "email": user["email"],
-                        "role": user["role"],
-                        "city": user["city"],
-                    },
-                },
+            conn.execute(
+                "INSERT INTO sessions(user_id, token, expires_at, created_at) VALUES(?, ?, ?, ?)",
+                (user["id"], token, to_iso(expires_at), now_iso),
             )
-            return
+            conn.commit()
 
-        user = self._auth_user()
-        if not user:
-            self._unauthorized()
-            return
+        self._send_json(
+            HTTPStatus.OK,
+            {
+                "ok": True,
+                "token": token,
+                "user": {
+                    "id": user["id"],
+                    "name": user["name"],
+                    "email": user["email"],
+                    "role": user["role"],
+                    "city": user["city"],
+                },
+            },
+        )
 
-        if method == "GET" and path == "/api/auth/me":
-            self._send_json(
-                HTTPStatus.OK,
-                {
-                    "ok": True,
-                    "user": {
-                        "id": user["id"],
-                        "name": user["name"],
-                        "email": user["email"],
-                        "role": user["role"],
-                        "city": user["city"],
-                        "active": user["active"],
-                    },
+    def _get_auth_me(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        self._send_json(
+            HTTPStatus.OK,
+            {
+                "ok": True,
+                "user": {
+                    "id": user["id"],
+                    "name": user["name"],
+                    "email": user["email"],
+                    "role": user["role"],
+                    "city": user["city"],
+                    "active": user["active"],
                 },
+            },
+        )
+
+    def _get_dashboard(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        key = (user["id"], user["role"])
+        metrics = get_cached_dashboard_metrics(key)
+        if metrics is None:
+            with connect_db_readonly() as conn:
+                metrics = build_dashboard_metrics(conn, user, now_iso)
+            cache_dashboard_metrics(key, metrics)
+        etag = compute_etag("dashboard", key, metrics)
+        if self._send_not_modified(etag):
+            return
+        self._send_json(HTTPStatus.OK, {"ok": True, "metrics": metrics}, etag)
+
+    def _get_inventory(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        city = query.get("city", "")
+        include_hidden = query.get("include_hidden", "false") == "true"
+        params: list = []
+        where = []
+
+        if user["role"] == ROLE_BROKER:
+            where.append("broker_id = ?")
+            params.append(user["id"])
+        elif user["role"] == ROLE_RM:
+            assigned, assigned_json = self._assigned_brokers(user["id"])
+            if not assigned:
+                self._send_json_body(HTTPStatus.OK, EMPTY_ITEMS_JSON_BODY)
+                return
+            where.append("broker_id IN (SELECT value FROM json_each(?))")
+            params.append(assigned_json)
+
+        if city:
+            where.append("city = ?")
+            params.append(city)
+
+        if not include_hidden:
+            where.append("hidden_from_customers = 0")
+
+        where_sql = " WHERE " + " AND ".join(where) if where else ""
+        generation = _write_generation
+        with connect_db_readonly() as conn:
+            signature = conn.execute(
+                f"SELECT COUNT(*), MAX(updated_at) FROM properties{where_sql}",
+                tuple(params),
+            ).fetchone()
+            etag = compute_etag("inventory", user["id"], where_sql, params, generation, tuple(signature))
+            if self._send_not_modified(etag):
+                return
+            self._send_json_items(
+                conn.execute(
+                    f"SELECT {INVENTORY_LIST_COLUMNS} FROM properties{where_sql} ORDER BY created_at DESC",
+                    tuple(params),
+                ),
+                etag,
             )
+
+    def _get_inventory_item(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        try:
+            property_id = int(query.get("id") or 0)
+        except ValueError:
+            property_id = 0
+        if not property_id:
+            self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "id is required"})
             return
 
-        if method == "GET" and path == "/api/dashboard":
-            with connect_db() as conn:
-                if user["role"] == ROLE_BROKER:
-                    metrics = conn.execute(
-                        """
-                        SELECT
-                            SUM(CASE WHEN status IN (?, ?, ?) THEN 1 ELSE 0 END) AS inventory_count,
-                            SUM(CASE WHEN status = ? AND start_at >= ? THEN 1 ELSE 0 END) AS upcoming_visits
-                        FROM visits
-                        WHERE broker_id = ?
-                        """,
-                        (
-                            VISIT_STATUS_SCHEDULED,
-                            VISIT_STATUS_COMPLETED,
-                            VISIT_STATUS_CANCELLED_BROKER,
-                            VISIT_STATUS_SCHEDULED,
-                            to_iso(now_local()),
-                            user["id"],
-                        ),
-                    ).fetchone()
+        with connect_db_readonly() as conn:
+            item = conn.execute("SELECT * FROM properties WHERE id = ?", (property_id,)).fetchone()
+        if item is not None:
+            if user["role"] == ROLE_BROKER and item["broker_id"] != user["id"]:
+                item = None
+            elif user["role"] == ROLE_RM and item["broker_id"] not in self._assigned_broker_ids(user["id"]):
+                item = None
+        if item is None:
+            self._send_json(HTTPStatus.NOT_FOUND, {"ok": False, "error": "Property not found"})
+            return
+        self._send_json(HTTPStatus.OK, {"ok": True, "item": dict(item)})
 
-                    property_row = conn.execute(
-                        "SELECT COUNT(*) AS c FROM properties WHERE broker_id = ? AND status IN (?, ?)",
-                        (user["id"], PROPERTY_STATUS_ACTIVE, PROPERTY_STATUS_BACKUP),
-                    ).fetchone()
+    def _post_inventory(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        if not require_role(user, [ROLE_BROKER]):
+            self._forbidden()
+            return
 
-                    active_flags = active_flag_count(conn, user["id"])
-                    self._send_json(
-                        HTTPStatus.OK,
-                        {
-                            "ok": True,
-                            "metrics": {
-                                "inventory": property_row["c"],
-                                "upcoming_visits": metrics["upcoming_visits"] or 0,
-                                "active_flags": active_flags,
-                            },
-                        },
-                    )
-                    return
+        data = parse_request_body(self)
+        try:
+            fields = coerce_fields(data, INVENTORY_FIELDS)
+        except ValueError as exc:
+            self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": str(exc)})
+            return
 
-                if user["role"] == ROLE_RM:
-                    assigned_brokers = conn.execute(
-                        "SELECT broker_id FROM rm_assignments WHERE rm_id = ?",
-                        (user["id"],),
-                    ).fetchall()
-                    broker_ids = [row["broker_id"] for row in assigned_brokers]
-                    broker_placeholders = ",".join("?" for _ in broker_ids) or "NULL"
-
-                    duplicate_pending = 0
-                    emergency_pending = 0
-                    if broker_ids:
-                        duplicate_pending = conn.execute(
-                            f"""
-                            SELECT COUNT(*) AS c
-                            FROM duplicate_review_queue dq
-                            JOIN properties p ON p.id = dq.property_id
-                            WHERE dq.status = 'pending' AND p.broker_id IN ({broker_placeholders})
-                            """,
-                            tuple(broker_ids),
-                        ).fetchone()["c"]
-
-                        emergency_pending = conn.execute(
-                            f"""
-                            SELECT COUNT(*) AS c
-                            FROM cancellation_incidents
-                            WHERE status = ? AND broker_id IN ({broker_placeholders})
-                            """,
-                            (INCIDENT_PENDING_RM, *broker_ids),
-                        ).fetchone()["c"]
+        with connect_db() as conn:
+            cursor = conn.execute(
+                """
+                INSERT INTO properties(
+                    broker_id, title, asset_type, configuration, spec_value, spec_unit,
+                    bhk, area_value, location_text, city, price, maps_url, latitude, longitude,
+                    amenities, image_url, status, hidden_from_customers, created_at, updated_at
+                ) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?)
+                RETURNING *
+                """,
+                (user["id"], *fields, PROPERTY_STATUS_ACTIVE, now_iso, now_iso),
+            )
+            item = cursor.fetchone()
+            duplicate_info = run_duplicate_checks(conn, item["id"], item, now_dt)
+            if duplicate_info["matched"]:
+                item = conn.execute("SELECT * FROM properties WHERE id = ?", (item["id"],)).fetchone()
+            conn.commit()
 
-                    self._send_json(
-                        HTTPStatus.OK,
-                        {
-                            "ok": True,
-                            "metrics": {
-                                "assigned_brokers": len(broker_ids),
-                                "duplicate_queue": duplicate_pending,
-                                "emergency_queue": emergency_pending,
-                            },
-                        },
-                    )
-                    return
+        self._send_json(
+            HTTPStatus.OK,
+            {"ok": True, "property": dict(item), "duplicate_check": duplicate_info},
+        )
 
-                escalations = conn.execute(
-                    "SELECT COUNT(*) AS c FROM cancellation_incidents WHERE status = ?",
-                    (INCIDENT_ESCALATED,),
-                ).fetchone()["c"]
-                self._send_json(
-                    HTTPStatus.OK,
-                    {
-                        "ok": True,
-                        "metrics": {
-                            "escalations": escalations,
-                        },
-                    },
-                )
+    def _post_inventory_remove(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        if not require_role(user, [ROLE_BROKER]):
+            self._forbidden()
             return
 
-        if method == "GET" and path == "/api/inventory":
-            city = query.get("city", "")
-            include_hidden = query.get("include_hidden", "false") == "true"
-            params: list = []
-            where = []
-
-            if user["role"] == ROLE_BROKER:
-                where.append("broker_id = ?")
-                params.append(user["id"])
-            elif user["role"] == ROLE_RM:
-                assigned = self._assigned_broker_ids(user["id"])
-                if not assigned:
-                    self._send_json(HTTPStatus.OK, {"ok": True, "items": []})
-                    return
-                where.append("broker_id IN ({})".format(",".join("?" for _ in assigned)))
-                params.extend(assigned)
+        data = parse_request_body(self)
+        property_id = int(data.get("property_id") or 0)
+        reason = (data.get("reason") or "").strip()
+        details = (data.get("details") or "").strip()
+        if not property_id or not reason:
+            self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "property_id and reason are required"})
+            return
 
-            if city:
-                where.append("city = ?")
-                params.append(city)
+        status = PROPERTY_STATUS_SOLD if normalize_text(reason) == "property already sold" else PROPERTY_STATUS_WITHDRAWN
 
-            if not include_hidden:
-                where.append("hidden_from_customers = 0")
+        with connect_db() as conn:
+            row = conn.execute(
+                "SELECT id FROM properties WHERE id = ? AND broker_id = ?",
+                (property_id, user["id"]),
+            ).fetchone()
+            if not row:
+                self._send_json(HTTPStatus.NOT_FOUND, {"ok": False, "error": "Property not found"})
+                return
 
-            sql = "SELECT * FROM properties"
-            if where:
-                sql += " WHERE " + " AND ".join(where)
-            sql += " ORDER BY created_at DESC"
+            conn.execute(
+                "UPDATE properties SET status = ?, hidden_from_customers = 1, updated_at = ? WHERE id = ?",
+                (status, now_iso, property_id),
+            )
+            conn.execute(
+                "INSERT INTO property_removal_log(property_id, broker_id, reason, details, created_at) VALUES(?, ?, ?, ?, ?)",
+                (property_id, user["id"], reason, details, now_iso),
+            )
+            conn.commit()
 
-            with connect_db() as conn:
-                rows = conn.execute(sql, tuple(params)).fetchall()
+        self._send_json(HTTPStatus.OK, {"ok": True, "property_id": property_id, "status": status})
 
-            items = [dict(row) for row in rows]
-            self._send_json(HTTPStatus.OK, {"ok": True, "items": items})
+    def _get_rm_duplicate_queue(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        if not require_role(user, [ROLE_RM]):
+            self._forbidden()
             return
 
-        if method == "POST" and path == "/api/inventory":
-            if not require_role(user, [ROLE_BROKER]):
-                self._forbidden()
-                return
-
-            data = parse_request_body(self)
-            required_fields = ["title", "asset_type", "location_text", "city", "price"]
-            missing = [field for field in required_fields if not data.get(field)]
-            if missing:
-                self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": f"Missing fields: {', '.join(missing)}"})
-                return
-
-            now = to_iso(now_local())
-            with connect_db() as conn:
-                conn.execute(
-                    """
-                    INSERT INTO properties(
-                        broker_id, title, asset_type, configuration, spec_value, spec_unit,
-                        bhk, area_value, location_text, city, price, maps_url, latitude, longitude,
-                        amenities, image_url, status, hidden_from_customers, created_at, updated_at
-                    ) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?)
-                    """,
-                    (
-                        user["id"],
-                        data.get("title"),
-                        data.get("asset_type"),
-                        data.get("configuration"),
-                        float(data.get("spec_value")) if data.get("spec_value") else None,
-                        data.get("spec_unit"),
-                        data.get("bhk"),
-                        float(data.get("area_value")) if data.get("area_value") else None,
-                        data.get("location_text"),
-                        data.get("city"),
-                        float(data.get("price")),
-                        data.get("maps_url"),
-                        float(data.get("latitude")) if data.get("latitude") else None,
-                        float(data.get("longitude")) if data.get("longitude") else None,
-                        data.get("amenities"),
-                        data.get("image_url"),
-                        PROPERTY_STATUS_ACTIVE,
-                        now,
-                        now,
-                    ),
-                )
-                property_id = conn.execute("SELECT last_insert_rowid() AS id").fetchone()["id"]
-                duplicate_info = run_duplicate_checks(conn, property_id)
-                conn.commit()
+        with connect_db_readonly() as conn:
+            rows = conn.execute(
+                """
+                SELECT
+                    dq.*, p.title AS property_title, p.city, p.broker_id,
+                    m.title AS matched_property_title
+                FROM duplicate_review_queue dq
+                JOIN properties p ON p.id = dq.property_id
+                JOIN properties m ON m.id = dq.matched_property_id
+                WHERE dq.status = 'pending'
+                  AND p.broker_id IN (SELECT broker_id FROM rm_assignments WHERE rm_id = ?)
+                ORDER BY dq.created_at ASC
+                """,
+                (user["id"],),
+            )
+            self._send_json_items(rows)
 
-                item = conn.execute("SELECT * FROM properties WHERE id = ?", (property_id,)).fetchone()
+    def _post_rm_duplicate_review(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        if not require_role(user, [ROLE_RM]):
+            self._forbidden()
+            return
 
-            self._send_json(
-                HTTPStatus.OK,
-                {"ok": True, "property": dict(item), "duplicate_check": duplicate_info},
-            )
+        data = parse_request_body(self)
+        queue_id = int(data.get("queue_id") or 0)
+        decision = (data.get("decision") or "").strip()
+        notes = (data.get("notes") or "").strip()
+        if decision not in ["approve_visible", "mark_duplicate", "keep_backup"]:
+            self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "Invalid decision"})
             return
 
-        if method == "POST" and path == "/api/inventory/remove":
-            if not require_role(user, [ROLE_BROKER]):
-                self._forbidden()
+        with connect_db() as conn:
+            row = conn.execute(
+                """
+                SELECT dq.*, p.broker_id
+                FROM duplicate_review_queue dq
+                JOIN properties p ON p.id = dq.property_id
+                WHERE dq.id = ? AND dq.status = 'pending'
+                """,
+                (queue_id,),
+            ).fetchone()
+            if not row:
+                self._send_json(HTTPStatus.NOT_FOUND, {"ok": False, "error": "Queue item not found"})
                 return
 
-            data = parse_request_body(self)
-            property_id = int(data.get("property_id") or 0)
-            reason = (data.get("reason") or "").strip()
-            details = (data.get("details") or "").strip()
-            if not property_id or not reason:
-                self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "property_id and reason are required"})
+            assigned = self._assigned_broker_ids(user["id"])
+            if row["broker_id"] not in assigned:
+                self._forbidden()
                 return
 
-            status = PROPERTY_STATUS_SOLD if normalize_text(reason) == "property already sold" else PROPERTY_STATUS_WITHDRAWN
-
-            with connect_db() as conn:
-                row = conn.execute(
-                    "SELECT * FROM properties WHERE id = ? AND broker_id = ?",
-                    (property_id, user["id"]),
-                ).fetchone()
-                if not row:
-                    self._send_json(HTTPStatus.NOT_FOUND, {"ok": False, "error": "Property not found"})
-                    return
-
+            if decision == "approve_visible":
+                conn.execute(
+                    "UPDATE properties SET status = ?, hidden_from_customers = 0, updated_at = ? WHERE id = ?",
+                    (PROPERTY_STATUS_ACTIVE, now_iso, row["property_id"]),
+                )
+            elif decision == "mark_duplicate":
                 conn.execute(
                     "UPDATE properties SET status = ?, hidden_from_customers = 1, updated_at = ? WHERE id = ?",
-                    (status, to_iso(now_local()), property_id),
+                    (PROPERTY_STATUS_DUPLICATE_REJECTED, now_iso, row["property_id"]),
                 )
+            else:
                 conn.execute(
-                    "INSERT INTO property_removal_log(property_id, broker_id, reason, details, created_at) VALUES(?, ?, ?, ?, ?)",
-                    (property_id, user["id"], reason, details, to_iso(now_local())),
+                    """
+                    UPDATE properties
+                    SET status = ?, hidden_from_customers = 1, primary_property_id = ?, updated_at = ?
+                    WHERE id = ?
+                    """,
+                    (PROPERTY_STATUS_BACKUP, row["matched_property_id"], now_iso, row["property_id"]),
                 )
-                conn.commit()
 
-            self._send_json(HTTPStatus.OK, {"ok": True, "property_id": property_id, "status": status})
-            return
+            conn.execute(
+                """
+                UPDATE duplicate_review_queue
+                SET status = 'resolved', rm_id = ?, decision = ?, notes = ?, updated_at = ?
+                WHERE id = ?
+                """,
+                (user["id"], decision, notes, now_iso, queue_id),
+            )
+            conn.commit()
 
-        if method == "GET" and path == "/api/rm/duplicate-queue":
-            if not require_role(user, [ROLE_RM]):
-                self._forbidden()
-                return
+        self._send_json(HTTPStatus.OK, {"ok": True})
 
-            assigned = self._assigned_broker_ids(user["id"])
+    def _get_slots(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        params = []
+        where = []
+        if user["role"] == ROLE_BROKER:
+            where.append("broker_id = ?")
+            params.append(user["id"])
+        elif user["role"] == ROLE_RM:
+            assigned, assigned_json = self._assigned_brokers(user["id"])
             if not assigned:
-                self._send_json(HTTPStatus.OK, {"ok": True, "items": []})
-                return
-
-            with connect_db() as conn:
-                rows = conn.execute(
-                    f"""
-                    SELECT
-                        dq.*, p.title AS property_title, p.city, p.broker_id,
-                        m.title AS matched_property_title
-                    FROM duplicate_review_queue dq
-                    JOIN properties p ON p.id = dq.property_id
-                    JOIN properties m ON m.id = dq.matched_property_id
-                    WHERE dq.status = 'pending' AND p.broker_id IN ({','.join('?' for _ in assigned)})
-                    ORDER BY dq.created_at ASC
-                    """,
-                    tuple(assigned),
-                ).fetchall()
-            self._send_json(HTTPStatus.OK, {"ok": True, "items": [dict(r) for r in rows]})
-            return
-
-        if method == "POST" and path == "/api/rm/duplicate-review":
-            if not require_role(user, [ROLE_RM]):
-                self._forbidden()
-                return
-
-            data = parse_request_body(self)
-            queue_id = int(data.get("queue_id") or 0)
-            decision = (data.get("decision") or "").strip()
-            notes = (data.get("notes") or "").strip()
-            if decision not in ["approve_visible", "mark_duplicate", "keep_backup"]:
-                self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "Invalid decision"})
+                self._send_json_body(HTTPStatus.OK, EMPTY_ITEMS_JSON_BODY)
                 return
+            where.append("broker_id IN (SELECT value FROM json_each(?))")
+            params.append(assigned_json)
 
-            with connect_db() as conn:
-                row = conn.execute(
-                    """
-                    SELECT dq.*, p.broker_id
-                    FROM duplicate_review_queue dq
-                    JOIN properties p ON p.id = dq.property_id
-                    WHERE dq.id = ? AND dq.status = 'pending'
-                    """,
-                    (queue_id,),
-                ).fetchone()
-                if not row:
-                    self._send_json(HTTPStatus.NOT_FOUND, {"ok": False, "error": "Queue item not found"})
-                    return
-
-                assigned = self._assigned_broker_ids(user["id"])
-                if row["broker_id"] not in assigned:
-                    self._forbidden()
-                    return
+        city = query.get("city")
+        if city:
+            where.append("city = ?")
+            params.append(city)
 
-                if decision == "approve_visible":
-                    conn.execute(
-                        "UPDATE properties SET status = ?, hidden_from_customers = 0, updated_at = ? WHERE id = ?",
-                        (PROPERTY_STATUS_ACTIVE, to_iso(now_local()), row["property_id"]),
-                    )
-                elif decision == "mark_duplicate":
-                    conn.execute(
-                        "UPDATE properties SET status = ?, hidden_from_customers = 1, updated_at = ? WHERE id = ?",
-                        (PROPERTY_STATUS_DUPLICATE_REJECTED, to_iso(now_local()), row["property_id"]),
-                    )
-                else:
-                    conn.execute(
-                        """
-                        UPDATE properties
-                        SET status = ?, hidden_from_customers = 1, primary_property_id = ?, updated_at = ?
-                        WHERE id = ?
-                        """,
-                        (PROPERTY_STATUS_BACKUP, row["matched_property_id"], to_iso(now_local()), row["property_id"]),
-                    )
+        sql = "SELECT * FROM slots"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY start_at ASC"
 
-                conn.execute(
-                    """
-                    UPDATE duplicate_review_queue
-                    SET status = 'resolved', rm_id = ?, decision = ?, notes = ?, updated_at = ?
-                    WHERE id = ?
-                    """,
-                    (user["id"], decision, notes, to_iso(now_local()), queue_id),
-                )
-                conn.commit()
+        with connect_db_readonly() as conn:
+            self._send_json_items(conn.execute(sql, tuple(params)))
 
-            self._send_json(HTTPStatus.OK, {"ok": True})
+    def _post_slots_add(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        if not require_role(user, [ROLE_BROKER]):
+            self._forbidden()
             return
 
-        if method == "GET" and path == "/api/slots":
-            params = []
-            where = []
-            if user["role"] == ROLE_BROKER:
-                where.append("broker_id = ?")
-                params.append(user["id"])
-            elif user["role"] == ROLE_RM:
-                assigned = self._assigned_broker_ids(user["id"])
-                if not assigned:
-                    self._send_json(HTTPStatus.OK, {"ok": True, "items": []})
-                    return
-                where.append("broker_id IN ({})".format(",".join("?" for _ in assigned)))
-                params.extend(assigned)
-
-            city = query.get("city")
-            if city:
-                where.append("city = ?")
-                params.append(city)
-
-            sql = "SELECT * FROM slots"
-            if where:
-                sql += " WHERE " + " AND ".join(where)
-            sql += " ORDER BY start_at ASC"
+        data = parse_request_body(self)
+        start_at = parse_iso(data.get("start_at"))
+        end_at = parse_iso(data.get("end_at"))
+        city = data.get("city") or user["city"]
 
-            with connect_db() as conn:
-                rows = conn.execute(sql, tuple(params)).fetchall()
-
-            self._send_json(HTTPStatus.OK, {"ok": True, "items": [dict(r) for r in rows]})
+        if not start_at or not end_at or end_at <= start_at:
+            self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "Invalid start/end time"})
             return
 
-        if method == "POST" and path == "/api/slots/add":
-            if not require_role(user, [ROLE_BROKER]):
-                self._forbidden()
+        with connect_db() as conn:
+            overlap = conn.execute(
+                """
+                SELECT 1
+                FROM slots
+                WHERE broker_id = ?
+                  AND status IN (?, ?)
+                  AND start_at < ?
+                  AND end_at > ?
+                LIMIT 1
+                """,
+                (
+                    user["id"],
+                    SLOT_STATUS_OPEN,
+                    SLOT_STATUS_BOOKED,
+                    to_iso(end_at),
+                    to_iso(start_at),
+                ),
+            ).fetchone()
+            if overlap:
+                self._send_json(HTTPStatus.CONFLICT, {"ok": False, "error": "Slot overlaps with existing slot"})
                 return
 
-            data = parse_request_body(self)
-            start_at = parse_iso(data.get("start_at"))
-            end_at = parse_iso(data.get("end_at"))
-            city = data.get("city") or user["city"]
+            cursor = conn.execute(
+                """
+                INSERT INTO slots(broker_id, city, start_at, end_at, status, created_at, updated_at)
+                VALUES(?, ?, ?, ?, ?, ?, ?)
+                """,
+                (user["id"], city, to_iso(start_at), to_iso(end_at), SLOT_STATUS_OPEN, now_iso, now_iso),
+            )
+            slot_id = cursor.lastrowid
+            conn.commit()
 
-            if not start_at or not end_at or end_at <= start_at:
-                self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "Invalid start/end time"})
-                return
+        self._send_json(HTTPStatus.OK, {"ok": True, "slot_id": slot_id})
 
-            with connect_db() as conn:
-                overlap = conn.execute(
-                    """
-                    SELECT id
-                    FROM slots
-                    WHERE broker_id = ?
-                      AND status IN (?, ?)
-                      AND NOT (? <= start_at OR ? >= end_at)
-                    """,
-                    (
-                        user["id"],
-                        SLOT_STATUS_OPEN,
-                        SLOT_STATUS_BOOKED,
-                        to_iso(start_at),
-                        to_iso(end_at),
-                    ),
-                ).fetchone()
-                if overlap:
-                    self._send_json(HTTPStatus.CONFLICT, {"ok": False, "error": "Slot overlaps with existing slot"})
-                    return
+    def _post_slots_cancel(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        if not require_role(user, [ROLE_BROKER]):
+            self._forbidden()
+            return
 
-                now = to_iso(now_local())
-                conn.execute(
-                    """
-                    INSERT INTO slots(broker_id, city, start_at, end_at, status, created_at, updated_at)
-                    VALUES(?, ?, ?, ?, ?, ?, ?)
-                    """,
-                    (user["id"], city, to_iso(start_at), to_iso(end_at), SLOT_STATUS_OPEN, now, now),
-                )
-                slot_id = conn.execute("SELECT last_insert_rowid() AS id").fetchone()["id"]
-                conn.commit()
+        data = parse_request_body(self)
+        slot_id = int(data.get("slot_id") or 0)
+        reason = (data.get("reason") or "").strip()
+        emergency_requested = bool(data.get("emergency_requested"))
+        emergency_reason = (data.get("emergency_reason") or "").strip()
+        emergency_details = (data.get("emergency_details") or "").strip()
 
-            self._send_json(HTTPStatus.OK, {"ok": True, "slot_id": slot_id})
+        if not slot_id or not reason:
+            self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "slot_id and reason are required"})
             return
 
-        if method == "POST" and path == "/api/slots/cancel":
-            if not require_role(user, [ROLE_BROKER]):
-                self._forbidden()
+        with connect_db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            slot = conn.execute(
+                "SELECT id, status FROM slots WHERE id = ? AND broker_id = ?",
+                (slot_id, user["id"]),
+            ).fetchone()
+            if not slot:
+                self._send_json(HTTPStatus.NOT_FOUND, {"ok": False, "error": "Slot not found"})
                 return
 
-            data = parse_request_body(self)
-            slot_id = int(data.get("slot_id") or 0)
-            reason = (data.get("reason") or "").strip()
-            emergency_requested = bool(data.get("emergency_requested"))
-            emergency_reason = (data.get("emergency_reason") or "").strip()
-            emergency_details = (data.get("emergency_details") or "").strip()
-
-            if not slot_id or not reason:
-                self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "slot_id and reason are required"})
+            if slot["status"] in [SLOT_STATUS_CANCELLED, SLOT_STATUS_COMPLETED]:
+                self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "Slot already closed"})
                 return
 
-            now_dt = now_local()
-            now_iso = to_iso(now_dt)
+            visit = conn.execute(
+                """
+                SELECT id, start_ts
+                FROM visits
+                WHERE slot_id = ? AND status = ?
+                ORDER BY id DESC
+                LIMIT 1
+                """,
+                (slot_id, VISIT_STATUS_SCHEDULED),
+            ).fetchone()
 
-            with connect_db() as conn:
-                slot = conn.execute(
-                    "SELECT * FROM slots WHERE id = ? AND broker_id = ?",
-                    (slot_id, user["id"]),
-                ).fetchone()
-                if not slot:
-                    self._send_json(HTTPStatus.NOT_FOUND, {"ok": False, "error": "Slot not found"})
-                    return
+            conn.execute(
+                "UPDATE slots SET status = ?, cancel_reason = ?, cancelled_at = ?, updated_at = ? WHERE id = ?",
+                (SLOT_STATUS_CANCELLED, reason, now_iso, now_iso, slot_id),
+            )
 
-                if slot["status"] in [SLOT_STATUS_CANCELLED, SLOT_STATUS_COMPLETED]:
-                    self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "Slot already closed"})
-                    return
+            incident_id = None
+            priority_rebook_until = None
+            flagged = None
 
-                visit = conn.execute(
-                    """
-                    SELECT *
-                    FROM visits
-                    WHERE slot_id = ? AND status = ?
-                    ORDER BY id DESC
-                    LIMIT 1
-                    """,
-                    (slot_id, VISIT_STATUS_SCHEDULED),
-                ).fetchone()
+            if visit:
+                within_24h = False
+                if visit["start_ts"] is not None:
+                    within_24h = (visit["start_ts"] - to_epoch_seconds(now_dt)) <= DAY_SECONDS
+
+                if within_24h:
+                    priority_rebook_until = now_dt + timedelta(hours=48)
 
                 conn.execute(
-                    "UPDATE slots SET status = ?, cancel_reason = ?, cancelled_at = ?, updated_at = ? WHERE id = ?",
-                    (SLOT_STATUS_CANCELLED, reason, now_iso, now_iso, slot_id),
+                    """
+                    UPDATE visits
+                    SET status = ?, cancelled_by = ?, cancellation_reason = ?,
+                        priority_rebook_until = ?, updated_at = ?
+                    WHERE id = ?
+                    """,
+                    (
+                        VISIT_STATUS_CANCELLED_BROKER,
+                        "broker",
+                        reason,
+                        to_iso(priority_rebook_until) if priority_rebook_until else None,
+                        now_iso,
+                        visit["id"],
+                    ),
                 )
 
-                incident_id = None
-                priority_rebook_until = None
-                flagged = None
-
-                if visit:
-                    start_at = parse_iso(visit["start_at"])
-                    within_24h = False
-                    if start_at:
-                        within_24h = (start_at - now_dt) <= timedelta(hours=24)
-
-                    if within_24h:
-                        priority_rebook_until = now_dt + timedelta(hours=48)
-
-                    conn.execute(
-                        """
-                        UPDATE visits
-                        SET status = ?, cancelled_by = ?, cancellation_reason = ?,
-                            priority_rebook_until = ?, updated_at = ?
-                        WHERE id = ?
-                        """,
-                        (
-                            VISIT_STATUS_CANCELLED_BROKER,
-                            "broker",
-                            reason,
-                            to_iso(priority_rebook_until) if priority_rebook_until else None,
-                            now_iso,
-                            visit["id"],
-                        ),
-                    )
-
-                    record_event(
-                        conn,
+                events = [
+                    (
                         "customer_apology_sent",
                         "visit",
                         visit["id"],
@@ -2304,164 +3196,166 @@ class AppHandler(BaseHTTPRequestHandler):
                             "within_24h": within_24h,
                         },
                     )
-                    send_visit_whatsapp(
-                        conn,
-                        visit_id=visit["id"],
-                        template_name="broker_cancel_with_priority" if within_24h else "broker_cancel_without_priority",
-                        source="broker_slot_cancel",
+                ]
+                if within_24h:
+                    events.append(("rm_call_triggered", "visit", visit["id"], {"reason": "broker_cancelled_within_24h"}))
+                record_events(conn, events, now_iso)
+                send_visit_whatsapp(
+                    conn,
+                    visit_id=visit["id"],
+                    template_name="broker_cancel_with_priority" if within_24h else "broker_cancel_without_priority",
+                    source="broker_slot_cancel",
+                    created_at=now_iso,
+                )
+
+                if within_24h:
+                    status = INCIDENT_PENDING_RM if emergency_requested else INCIDENT_REJECTED_NO_EMERGENCY
+                    sla_due_at = calc_rm_sla(now_dt) if emergency_requested else None
+
+                    cursor = conn.execute(
+                        """
+                        INSERT INTO cancellation_incidents(
+                            slot_id, visit_id, broker_id, raised_at, within_24h, is_booked,
+                            emergency_requested, emergency_reason, emergency_details, status,
+                            sla_due_at, created_at, updated_at
+                        ) VALUES(?, ?, ?, ?, 1, 1, ?, ?, ?, ?, ?, ?, ?)
+                        """,
+                        (
+                            slot_id,
+                            visit["id"],
+                            user["id"],
+                            now_iso,
+                            1 if emergency_requested else 0,
+                            emergency_reason,
+                            emergency_details,
+                            status,
+                            to_iso(sla_due_at),
+                            now_iso,
+                            now_iso,
+                        ),
                     )
+                    incident_id = cursor.lastrowid
 
-                    if within_24h:
-                        record_event(
+                    if not emergency_requested:
+                        flagged = apply_flag(
                             conn,
-                            "rm_call_triggered",
-                            "visit",
-                            visit["id"],
-                            {"reason": "broker_cancelled_within_24h"},
+                            user["id"],
+                            incident_id,
+                            "Booked visit cancelled within 24h without emergency approval",
+                            now_dt,
                         )
-
-                        status = INCIDENT_PENDING_RM if emergency_requested else INCIDENT_REJECTED_NO_EMERGENCY
-                        sla_due_at = calc_rm_sla(now_dt) if emergency_requested else None
-
                         conn.execute(
                             """
-                            INSERT INTO cancellation_incidents(
-                                slot_id, visit_id, broker_id, raised_at, within_24h, is_booked,
-                                emergency_requested, emergency_reason, emergency_details, status,
-                                sla_due_at, created_at, updated_at
-                            ) VALUES(?, ?, ?, ?, 1, 1, ?, ?, ?, ?, ?, ?, ?)
+                            UPDATE cancellation_incidents
+                            SET resolved_at = ?, updated_at = ?
+                            WHERE id = ?
                             """,
-                            (
-                                slot_id,
-                                visit["id"],
-                                user["id"],
-                                now_iso,
-                                1 if emergency_requested else 0,
-                                emergency_reason,
-                                emergency_details,
-                                status,
-                                to_iso(sla_due_at),
-                                now_iso,
-                                now_iso,
-                            ),
+                            (now_iso, now_iso, incident_id),
                         )
-                        incident_id = conn.execute("SELECT last_insert_rowid() AS id").fetchone()["id"]
-
-                        if not emergency_requested:
-                            flagged = apply_flag(
-                                conn,
-                                user["id"],
-                                incident_id,
-                                "Booked visit cancelled within 24h without emergency approval",
-                            )
-                            conn.execute(
-                                """
-                                UPDATE cancellation_incidents
-                                SET resolved_at = ?, updated_at = ?
-                                WHERE id = ?
-                                """,
-                                (now_iso, now_iso, incident_id),
-                            )
-
-                conn.commit()
 
-            self._send_json(
-                HTTPStatus.OK,
-                {
-                    "ok": True,
-                    "slot_id": slot_id,
-                    "incident_id": incident_id,
-                    "flag": flagged,
-                },
-            )
-            return
-
-        if method == "GET" and path == "/api/visits":
-            params = []
-            where = []
-
-            if user["role"] == ROLE_BROKER:
-                where.append("v.broker_id = ?")
-                params.append(user["id"])
-            elif user["role"] == ROLE_RM:
-                assigned = self._assigned_broker_ids(user["id"])
-                if not assigned:
-                    self._send_json(HTTPStatus.OK, {"ok": True, "items": []})
-                    return
-                where.append("v.broker_id IN ({})".format(",".join("?" for _ in assigned)))
-                params.extend(assigned)
-
-            status_filter = query.get("status")
-            if status_filter:
-                where.append("v.status = ?")
-                params.append(status_filter)
+            conn.commit()
 
-            sql = """
-                SELECT
-                    v.*, c.name AS customer_name, c.phone_norm,
-                    p.title AS property_title, s.city
-                FROM visits v
-                JOIN customers c ON c.id = v.customer_id
-                JOIN properties p ON p.id = v.property_id
-                JOIN slots s ON s.id = v.slot_id
-            """
-            if where:
-                sql += " WHERE " + " AND ".join(where)
-            sql += " ORDER BY v.start_at ASC"
+        self._send_json(
+            HTTPStatus.OK,
+            {
+                "ok": True,
+                "slot_id": slot_id,
+                "incident_id": incident_id,
+                "flag": flagged,
+            },
+        )
 
-            with connect_db() as conn:
-                rows = conn.execute(sql, tuple(params)).fetchall()
+    def _get_visits(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        params = []
+        where = []
 
-            self._send_json(HTTPStatus.OK, {"ok": True, "items": [dict(r) for r in rows]})
+        if user["role"] == ROLE_BROKER:
+            where.append("v.broker_id = ?")
+            params.append(user["id"])
+        elif user["role"] == ROLE_RM:
+            assigned, assigned_json = self._assigned_brokers(user["id"])
+            if not assigned:
+                self._send_json_body(HTTPStatus.OK, EMPTY_ITEMS_JSON_BODY)
+                return
+            where.append("v.broker_id IN (SELECT value FROM json_each(?))")
+            params.append(assigned_json)
+
+        status_filter = query.get("status")
+        if status_filter:
+            where.append("v.status = ?")
+            params.append(status_filter)
+
+        sql = """
+            SELECT
+                v.id, v.slot_id, v.property_id, v.broker_id, v.rm_id, v.customer_id,
+                v.start_at, v.end_at, v.status, v.is_unique_visit,
+                c.name AS customer_name, c.phone_norm,
+                p.title AS property_title, s.city
+            FROM visits v
+            JOIN customers c ON c.id = v.customer_id
+            JOIN properties p ON p.id = v.property_id
+            JOIN slots s ON s.id = v.slot_id
+        """
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY v.start_at ASC"
+
+        with connect_db_readonly() as conn:
+            self._send_json_items(conn.execute(sql, tuple(params)))
+
+    def _post_visits_book(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        data = parse_request_body(self)
+        slot_id = int(data.get("slot_id") or 0)
+        property_id = int(data.get("property_id") or 0)
+        customer_phone = normalize_phone(data.get("customer_phone"))
+        customer_name = (data.get("customer_name") or "").strip()
+        customer_requirements = (data.get("customer_requirements") or "").strip()
+
+        if not slot_id or not property_id or not customer_phone:
+            self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "slot_id, property_id, customer_phone are required"})
             return
 
-        if method == "POST" and path == "/api/visits/book":
-            data = parse_request_body(self)
-            slot_id = int(data.get("slot_id") or 0)
-            property_id = int(data.get("property_id") or 0)
-            customer_phone = normalize_phone(data.get("customer_phone"))
-            customer_name = (data.get("customer_name") or "").strip()
-            customer_requirements = (data.get("customer_requirements") or "").strip()
+        with connect_db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                """
+                SELECT
+                    s.status AS slot_status, s.broker_id, s.start_at, s.end_at, s.start_ts,
+                    p.broker_id AS property_broker_id, p.title
+                FROM slots s, properties p
+                WHERE s.id = ? AND p.id = ?
+                """,
+                (slot_id, property_id),
+            ).fetchone()
 
-            if not slot_id or not property_id or not customer_phone:
-                self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "slot_id, property_id, customer_phone are required"})
+            if not row:
+                self._send_json(HTTPStatus.NOT_FOUND, {"ok": False, "error": "Slot or property not found"})
                 return
+            if row["slot_status"] != SLOT_STATUS_OPEN:
+                self._send_json(HTTPStatus.CONFLICT, {"ok": False, "error": "Slot not available"})
+                return
+            if row["property_broker_id"] != row["broker_id"]:
+                self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "Slot must belong to the same broker as property"})
+                return
+            slot = {
+                "id": slot_id,
+                "broker_id": row["broker_id"],
+                "start_at": row["start_at"],
+                "end_at": row["end_at"],
+                "start_ts": row["start_ts"],
+            }
+            prop = {"id": property_id, "title": row["title"]}
 
-            with connect_db() as conn:
-                slot = conn.execute(
-                    "SELECT * FROM slots WHERE id = ?",
-                    (slot_id,),
-                ).fetchone()
-                prop = conn.execute(
-                    "SELECT * FROM properties WHERE id = ?",
-                    (property_id,),
-                ).fetchone()
-
-                if not slot or not prop:
-                    self._send_json(HTTPStatus.NOT_FOUND, {"ok": False, "error": "Slot or property not found"})
-                    return
-                if slot["status"] != SLOT_STATUS_OPEN:
-                    self._send_json(HTTPStatus.CONFLICT, {"ok": False, "error": "Slot not available"})
-                    return
-                if prop["broker_id"] != slot["broker_id"]:
-                    self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "Slot must belong to the same broker as property"})
-                    return
-
-                customer = conn.execute(
-                    "SELECT * FROM customers WHERE phone_norm = ?",
-                    (customer_phone,),
-                ).fetchone()
-                if not customer:
-                    conn.execute(
-                        "INSERT INTO customers(name, phone_norm, created_at) VALUES(?, ?, ?)",
-                        (customer_name or "Customer", customer_phone, to_iso(now_local())),
-                    )
-                    customer_id = conn.execute("SELECT last_insert_rowid() AS id").fetchone()["id"]
-                else:
-                    customer_id = customer["id"]
-                    if customer_name:
-                        conn.execute("UPDATE customers SET name = ? WHERE id = ?", (customer_name, customer_id))
+            customer_id = conn.execute(
+                """
+                INSERT INTO customers(name, phone_norm, created_at) VALUES(?, ?, ?)
+                ON CONFLICT(phone_norm) DO UPDATE SET name = CASE WHEN ? THEN excluded.name ELSE name END
+                RETURNING id
+                """,
+                (customer_name or "Customer", customer_phone, now_iso, bool(customer_name)),
+            ).fetchone()["id"]
 
+            try:
                 visit_id = create_scheduled_visit(
                     conn,
                     slot_row=slot,
@@ -2469,684 +3363,713 @@ class AppHandler(BaseHTTPRequestHandler):
                     customer_id=customer_id,
                     customer_requirements=customer_requirements,
                     source="rm_booking",
+                    customer_phone=customer_phone,
+                    now=now_dt,
                 )
-                conn.commit()
+            except ValueError as exc:
+                conn.rollback()
+                self._send_json(HTTPStatus.CONFLICT, {"ok": False, "error": str(exc)})
+                return
+            conn.commit()
 
-            self._send_json(HTTPStatus.OK, {"ok": True, "visit_id": visit_id})
+        self._send_json(HTTPStatus.OK, {"ok": True, "visit_id": visit_id})
+
+    def _post_visits_send_otp(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        if not require_role(user, [ROLE_BROKER]):
+            self._forbidden()
             return
 
-        if method == "POST" and path == "/api/visits/send-otp":
-            if not require_role(user, [ROLE_BROKER]):
-                self._forbidden()
-                return
+        data = parse_request_body(self)
+        visit_id = int(data.get("visit_id") or 0)
+        if not visit_id:
+            self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "visit_id is required"})
+            return
+
+        code = f"{secrets.randbelow(1_000_000):06d}"
+        expires_iso = to_iso(now_dt + timedelta(seconds=OTP_TTL_SECONDS))
 
-            data = parse_request_body(self)
-            visit_id = int(data.get("visit_id") or 0)
-            if not visit_id:
-                self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "visit_id is required"})
+        with connect_db() as conn:
+            visit = conn.execute(
+                """
+                UPDATE visits
+                SET otp_code = ?, otp_expires_at = ?, otp_attempts = 0, otp_sent_at = ?, updated_at = ?
+                WHERE id = ? AND broker_id = ? AND status = ?
+                RETURNING (SELECT phone_norm FROM customers WHERE id = visits.customer_id) AS phone_norm
+                """,
+                (code, expires_iso, now_iso, now_iso, visit_id, user["id"], VISIT_STATUS_SCHEDULED),
+            ).fetchone()
+            if not visit:
+                self._send_json(HTTPStatus.NOT_FOUND, {"ok": False, "error": "Visit not eligible"})
                 return
 
-            code = f"{random.randint(0, 999999):06d}"
-            expires = now_local() + timedelta(seconds=OTP_TTL_SECONDS)
+            record_event(conn, "otp_sent", "visit", visit_id, {"expires_at": expires_iso}, now_iso)
+            send_whatsapp_template(
+                conn,
+                to_phone=visit["phone_norm"],
+                template_name="otp_verification",
+                context={"otp": code},
+                related_visit_id=visit_id,
+                source="broker_otp",
+                created_at=now_iso,
+            )
+            conn.commit()
 
-            with connect_db() as conn:
-                visit = conn.execute(
-                    """
-                    SELECT v.*, c.phone_norm
-                    FROM visits v
-                    JOIN customers c ON c.id = v.customer_id
-                    WHERE v.id = ? AND v.broker_id = ?
-                    """,
-                    (visit_id, user["id"]),
-                ).fetchone()
-                if not visit or visit["status"] != VISIT_STATUS_SCHEDULED:
-                    self._send_json(HTTPStatus.NOT_FOUND, {"ok": False, "error": "Visit not eligible"})
-                    return
+        self._send_json(
+            HTTPStatus.OK,
+            {
+                "ok": True,
+                "visit_id": visit_id,
+                "otp_expires_at": expires_iso,
+                "demo_otp": code,
+            },
+        )
 
-                conn.execute(
-                    """
-                    UPDATE visits
-                    SET otp_code = ?, otp_expires_at = ?, otp_attempts = 0, otp_sent_at = ?, updated_at = ?
-                    WHERE id = ?
-                    """,
-                    (code, to_iso(expires), to_iso(now_local()), to_iso(now_local()), visit_id),
-                )
-                record_event(conn, "otp_sent", "visit", visit_id, {"expires_at": to_iso(expires)})
-                send_whatsapp_template(
-                    conn,
-                    to_phone=visit["phone_norm"],
-                    template_name="otp_verification",
-                    context={"otp": code},
-                    related_visit_id=visit_id,
-                    source="broker_otp",
-                )
-                conn.commit()
+    def _post_visits_complete(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        if not require_role(user, [ROLE_BROKER]):
+            self._forbidden()
+            return
 
-            self._send_json(
-                HTTPStatus.OK,
-                {
-                    "ok": True,
-                    "visit_id": visit_id,
-                    "otp_expires_at": to_iso(expires),
-                    "demo_otp": code,
-                },
-            )
+        data = parse_request_body(self)
+        visit_id = int(data.get("visit_id") or 0)
+        otp = (data.get("otp") or "").strip()
+        photo = data.get("photo_base64") or ""
+        lat = data.get("lat")
+        lng = data.get("lng")
+
+        if not visit_id or not otp:
+            self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "visit_id and otp are required"})
             return
 
-        if method == "POST" and path == "/api/visits/complete":
-            if not require_role(user, [ROLE_BROKER]):
-                self._forbidden()
-                return
+        with connect_db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            visit = conn.execute(
+                f"""
+                SELECT {VISIT_COLUMNS}, p.latitude AS p_lat, p.longitude AS p_lng
+                FROM visits v
+                JOIN properties p ON p.id = v.property_id
+                WHERE v.id = ? AND v.broker_id = ?
+                """,
+                (visit_id, user["id"]),
+            ).fetchone()
 
-            data = parse_request_body(self)
-            visit_id = int(data.get("visit_id") or 0)
-            otp = (data.get("otp") or "").strip()
-            photo = data.get("photo_base64") or ""
-            lat = data.get("lat")
-            lng = data.get("lng")
+            if not visit or visit["status"] != VISIT_STATUS_SCHEDULED:
+                self._send_json(HTTPStatus.NOT_FOUND, {"ok": False, "error": "Visit not eligible"})
+                return
 
-            if not visit_id or not otp:
-                self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "visit_id and otp are required"})
+            if not visit["otp_code"]:
+                self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "Send OTP first"})
                 return
 
-            with connect_db() as conn:
-                visit = conn.execute(
-                    """
-                    SELECT v.*, p.latitude AS p_lat, p.longitude AS p_lng
-                    FROM visits v
-                    JOIN properties p ON p.id = v.property_id
-                    WHERE v.id = ? AND v.broker_id = ?
-                    """,
-                    (visit_id, user["id"]),
-                ).fetchone()
+            if visit["otp_attempts"] >= MAX_OTP_ATTEMPTS:
+                self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "OTP attempts exhausted"})
+                return
 
-                if not visit or visit["status"] != VISIT_STATUS_SCHEDULED:
-                    self._send_json(HTTPStatus.NOT_FOUND, {"ok": False, "error": "Visit not eligible"})
-                    return
+            expires_at = parse_iso(visit["otp_expires_at"])
+            if not expires_at or expires_at < now_dt:
+                self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "OTP expired"})
+                return
 
-                if not visit["otp_code"]:
-                    self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "Send OTP first"})
-                    return
+            if not hmac.compare_digest(otp.encode(), visit["otp_code"].encode()):
+                attempts = visit["otp_attempts"] + 1
+                conn.execute("UPDATE visits SET otp_attempts = ?, updated_at = ? WHERE id = ?", (attempts, now_iso, visit_id))
+                conn.commit()
+                self._send_json(
+                    HTTPStatus.BAD_REQUEST,
+                    {
+                        "ok": False,
+                        "error": "Invalid OTP",
+                        "remaining_attempts": max(0, MAX_OTP_ATTEMPTS - attempts),
+                    },
+                )
+                return
 
-                if visit["otp_attempts"] >= MAX_OTP_ATTEMPTS:
-                    self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "OTP attempts exhausted"})
-                    return
+            distance = None
+            completion_mode = None
+            lat_val = float(lat) if lat is not None else None
+            lng_val = float(lng) if lng is not None else None
 
-                expires_at = parse_iso(visit["otp_expires_at"])
-                if not expires_at or expires_at < now_local():
-                    self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "OTP expired"})
-                    return
+            if lat_val is not None and lng_val is not None and visit["p_lat"] is not None and visit["p_lng"] is not None:
+                distance = haversine_meters(lat_val, lng_val, float(visit["p_lat"]), float(visit["p_lng"]))
+                if distance <= GEO_RADIUS_METERS:
+                    completion_mode = "geo_checkin"
 
-                if otp != visit["otp_code"]:
-                    attempts = visit["otp_attempts"] + 1
-                    conn.execute("UPDATE visits SET otp_attempts = ?, updated_at = ? WHERE id = ?", (attempts, to_iso(now_local()), visit_id))
-                    conn.commit()
+            if completion_mode is None:
+                if not photo:
                     self._send_json(
                         HTTPStatus.BAD_REQUEST,
                         {
                             "ok": False,
-                            "error": "Invalid OTP",
-                            "remaining_attempts": max(0, MAX_OTP_ATTEMPTS - attempts),
+                            "error": "Geo check failed or unavailable. Upload customer photo fallback.",
                         },
                     )
                     return
+                completion_mode = "photo_fallback"
 
-                distance = None
-                completion_mode = None
-                lat_val = float(lat) if lat is not None else None
-                lng_val = float(lng) if lng is not None else None
-
-                if lat_val is not None and lng_val is not None and visit["p_lat"] is not None and visit["p_lng"] is not None:
-                    distance = haversine_meters(lat_val, lng_val, float(visit["p_lat"]), float(visit["p_lng"]))
-                    if distance <= GEO_RADIUS_METERS:
-                        completion_mode = "geo_checkin"
-
-                if completion_mode is None:
-                    if not photo:
-                        self._send_json(
-                            HTTPStatus.BAD_REQUEST,
-                            {
-                                "ok": False,
-                                "error": "Geo check failed or unavailable. Upload customer photo fallback.",
-                            },
-                        )
-                        return
-                    completion_mode = "photo_fallback"
-
-                prior_completed = conn.execute(
-                    """
-                    SELECT COUNT(*) AS c
-                    FROM visits
-                    WHERE customer_id = ?
-                      AND status = ?
-                      AND id != ?
-                    """,
-                    (visit["customer_id"], VISIT_STATUS_COMPLETED, visit_id),
-                ).fetchone()["c"]
-                is_unique = 1 if prior_completed == 0 else 0
+            photo_sha256 = None
+            if completion_mode == "photo_fallback":
+                try:
+                    photo_sha256 = store_visit_photo(photo)
+                except ValueError:
+                    self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "Invalid photo"})
+                    return
 
-                now = to_iso(now_local())
-                conn.execute(
-                    """
-                    UPDATE visits
-                    SET
-                        status = ?,
-                        checkin_lat = ?,
-                        checkin_lng = ?,
-                        distance_meters = ?,
-                        photo_fallback_base64 = ?,
-                        is_unique_visit = ?,
-                        completion_mode = ?,
-                        completed_at = ?,
-                        updated_at = ?
-                    WHERE id = ?
-                    """,
-                    (
-                        VISIT_STATUS_COMPLETED,
-                        lat_val,
-                        lng_val,
-                        distance,
-                        photo if completion_mode == "photo_fallback" else None,
-                        is_unique,
-                        completion_mode,
-                        now,
-                        now,
-                        visit_id,
+            is_unique = conn.execute(
+                """
+                UPDATE visits
+                SET
+                    status = ?,
+                    checkin_lat = ?,
+                    checkin_lng = ?,
+                    distance_meters = ?,
+                    photo_fallback_sha256 = ?,
+                    is_unique_visit = NOT EXISTS (
+                        SELECT 1
+                        FROM visits prior
+                        WHERE prior.customer_id = visits.customer_id
+                          AND prior.status = ?
+                          AND prior.id != visits.id
                     ),
-                )
-
-                conn.execute(
-                    "UPDATE slots SET status = ?, updated_at = ? WHERE id = ?",
-                    (SLOT_STATUS_COMPLETED, now, visit["slot_id"]),
-                )
-
-                record_event(
-                    conn,
-                    "visit_completed",
-                    "visit",
+                    completion_mode = ?,
+                    completed_at = ?,
+                    updated_at = ?
+                WHERE id = ? AND status = ?
+                RETURNING is_unique_visit
+                """,
+                (
+                    VISIT_STATUS_COMPLETED,
+                    lat_val,
+                    lng_val,
+                    distance,
+                    photo_sha256,
+                    VISIT_STATUS_COMPLETED,
+                    completion_mode,
+                    now_iso,
+                    now_iso,
                     visit_id,
-                    {
-                        "unique_visit": bool(is_unique),
-                        "completion_mode": completion_mode,
-                        "distance_meters": distance,
-                    },
-                )
-                conn.commit()
+                    VISIT_STATUS_SCHEDULED,
+                ),
+            ).fetchone()["is_unique_visit"]
 
-            self._send_json(
-                HTTPStatus.OK,
+            conn.execute(
+                "UPDATE slots SET status = ?, updated_at = ? WHERE id = ?",
+                (SLOT_STATUS_COMPLETED, now_iso, visit["slot_id"]),
+            )
+
+            record_event(
+                conn,
+                "visit_completed",
+                "visit",
+                visit_id,
                 {
-                    "ok": True,
-                    "visit_id": visit_id,
                     "unique_visit": bool(is_unique),
                     "completion_mode": completion_mode,
+                    "distance_meters": distance,
                 },
+                now_iso,
             )
-            return
+            conn.commit()
 
-        if method == "GET" and path == "/api/rm/emergency-queue":
-            if not require_role(user, [ROLE_RM]):
-                self._forbidden()
-                return
-            assigned = self._assigned_broker_ids(user["id"])
-            if not assigned:
-                self._send_json(HTTPStatus.OK, {"ok": True, "items": []})
-                return
-            with connect_db() as conn:
-                rows = conn.execute(
-                    f"""
-                    SELECT ci.*, v.start_at, c.phone_norm, c.name AS customer_name
-                    FROM cancellation_incidents ci
-                    JOIN visits v ON v.id = ci.visit_id
-                    JOIN customers c ON c.id = v.customer_id
-                    WHERE ci.status = ? AND ci.broker_id IN ({','.join('?' for _ in assigned)})
-                    ORDER BY ci.raised_at ASC
-                    """,
-                    (INCIDENT_PENDING_RM, *assigned),
-                ).fetchall()
-            self._send_json(HTTPStatus.OK, {"ok": True, "items": [dict(r) for r in rows]})
+        self._send_json(
+            HTTPStatus.OK,
+            {
+                "ok": True,
+                "visit_id": visit_id,
+                "unique_visit": bool(is_unique),
+                "completion_mode": completion_mode,
+            },
+        )
+
+    def _get_rm_emergency_queue(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        if not require_role(user, [ROLE_RM]):
+            self._forbidden()
+            return
+        assigned, assigned_json = self._assigned_brokers(user["id"])
+        if not assigned:
+            self._send_json_body(HTTPStatus.OK, EMPTY_ITEMS_JSON_BODY)
             return
+        with connect_db_readonly() as conn:
+            rows = conn.execute(
+                """
+                SELECT ci.*, v.start_at, c.phone_norm, c.name AS customer_name
+                FROM cancellation_incidents ci
+                JOIN visits v ON v.id = ci.visit_id
+                JOIN customers c ON c.id = v.customer_id
+                WHERE ci.status = ? AND ci.broker_id IN (SELECT value FROM json_each(?))
+                ORDER BY ci.raised_at ASC
+                """,
+                (INCIDENT_PENDING_RM, assigned_json),
+            )
+            self._send_json_items(rows)
 
-        if method == "POST" and path == "/api/rm/emergency-review":
-            if not require_role(user, [ROLE_RM]):
-                self._forbidden()
-                return
+    def _post_rm_emergency_review(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        if not require_role(user, [ROLE_RM]):
+            self._forbidden()
+            return
 
-            data = parse_request_body(self)
-            incident_id = int(data.get("incident_id") or 0)
-            approve = bool(data.get("approve"))
-            note = (data.get("note") or "").strip()
+        data = parse_request_body(self)
+        incident_id = int(data.get("incident_id") or 0)
+        approve = bool(data.get("approve"))
+        note = (data.get("note") or "").strip()
 
-            with connect_db() as conn:
-                incident = conn.execute(
-                    "SELECT * FROM cancellation_incidents WHERE id = ? AND status = ?",
+        assigned_json = self._assigned_brokers(user["id"])[1]
+        status = INCIDENT_APPROVED if approve else INCIDENT_REJECTED
+        with connect_db() as conn:
+            incident = conn.execute(
+                """
+                UPDATE cancellation_incidents
+                SET status = ?, rm_id = ?, rm_note = ?, resolved_at = ?, updated_at = ?
+                WHERE id = ? AND status = ? AND broker_id IN (SELECT value FROM json_each(?))
+                RETURNING broker_id
+                """,
+                (status, user["id"], note, now_iso, now_iso, incident_id, INCIDENT_PENDING_RM, assigned_json),
+            ).fetchone()
+            if not incident:
+                pending = conn.execute(
+                    "SELECT 1 FROM cancellation_incidents WHERE id = ? AND status = ?",
                     (incident_id, INCIDENT_PENDING_RM),
                 ).fetchone()
-                if not incident:
-                    self._send_json(HTTPStatus.NOT_FOUND, {"ok": False, "error": "Incident not found"})
-                    return
-
-                assigned = self._assigned_broker_ids(user["id"])
-                if incident["broker_id"] not in assigned:
+                if pending:
                     self._forbidden()
-                    return
-
-                now = to_iso(now_local())
-                status = INCIDENT_APPROVED if approve else INCIDENT_REJECTED
-                conn.execute(
-                    """
-                    UPDATE cancellation_incidents
-                    SET status = ?, rm_id = ?, rm_note = ?, resolved_at = ?, updated_at = ?
-                    WHERE id = ?
-                    """,
-                    (status, user["id"], note, now, now, incident_id),
-                )
-
-                flag = None
-                if not approve:
-                    flag = apply_flag(
-                        conn,
-                        incident["broker_id"],
-                        incident_id,
-                        "Emergency cancellation rejected by RM",
-                    )
+                else:
+                    self._send_json(HTTPStatus.NOT_FOUND, {"ok": False, "error": "Incident not found"})
+                return
 
-                record_event(
+            flag = None
+            if not approve:
+                flag = apply_flag(
                     conn,
-                    "rm_emergency_reviewed",
-                    "cancellation_incident",
+                    incident["broker_id"],
                     incident_id,
-                    {"approved": approve, "rm_id": user["id"]},
+                    "Emergency cancellation rejected by RM",
+                    now_dt,
                 )
-                conn.commit()
 
-            self._send_json(HTTPStatus.OK, {"ok": True, "flag": flag})
-            return
+            record_event(
+                conn,
+                "rm_emergency_reviewed",
+                "cancellation_incident",
+                incident_id,
+                {"approved": approve, "rm_id": user["id"]},
+                now_iso,
+            )
+            conn.commit()
 
-        if method == "GET" and path == "/api/srm/escalations":
-            if not require_role(user, [ROLE_SRM]):
-                self._forbidden()
-                return
+        self._send_json(HTTPStatus.OK, {"ok": True, "flag": flag})
 
-            with connect_db() as conn:
-                rows = conn.execute(
-                    """
-                    SELECT ci.*, v.start_at, c.name AS customer_name, c.phone_norm
-                    FROM cancellation_incidents ci
-                    JOIN visits v ON v.id = ci.visit_id
-                    JOIN customers c ON c.id = v.customer_id
-                    WHERE ci.status = ?
-                    ORDER BY ci.updated_at ASC
-                    """,
-                    (INCIDENT_ESCALATED,),
-                ).fetchall()
-            self._send_json(HTTPStatus.OK, {"ok": True, "items": [dict(r) for r in rows]})
+    def _get_srm_escalations(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        if not require_role(user, [ROLE_SRM]):
+            self._forbidden()
             return
 
-        if method == "POST" and path == "/api/srm/escalation-review":
-            if not require_role(user, [ROLE_SRM]):
-                self._forbidden()
-                return
+        with connect_db_readonly() as conn:
+            rows = conn.execute(
+                """
+                SELECT ci.*, v.start_at, c.name AS customer_name, c.phone_norm
+                FROM cancellation_incidents ci
+                JOIN visits v ON v.id = ci.visit_id
+                JOIN customers c ON c.id = v.customer_id
+                WHERE ci.status = ?
+                ORDER BY ci.updated_at ASC
+                """,
+                (INCIDENT_ESCALATED,),
+            )
+            self._send_json_items(rows)
 
-            data = parse_request_body(self)
-            incident_id = int(data.get("incident_id") or 0)
-            approve = bool(data.get("approve"))
-            note = (data.get("note") or "").strip()
+    def _post_srm_escalation_review(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        if not require_role(user, [ROLE_SRM]):
+            self._forbidden()
+            return
 
-            with connect_db() as conn:
-                incident = conn.execute(
-                    "SELECT * FROM cancellation_incidents WHERE id = ? AND status = ?",
-                    (incident_id, INCIDENT_ESCALATED),
-                ).fetchone()
-                if not incident:
-                    self._send_json(HTTPStatus.NOT_FOUND, {"ok": False, "error": "Escalation not found"})
-                    return
+        data = parse_request_body(self)
+        incident_id = int(data.get("incident_id") or 0)
+        approve = bool(data.get("approve"))
+        note = (data.get("note") or "").strip()
 
-                status = INCIDENT_APPROVED_SRM if approve else INCIDENT_REJECTED_SRM
-                now = to_iso(now_local())
-                conn.execute(
-                    """
-                    UPDATE cancellation_incidents
-                    SET status = ?, srm_id = ?, srm_note = ?, resolved_at = ?, updated_at = ?
-                    WHERE id = ?
-                    """,
-                    (status, user["id"], note, now, now, incident_id),
+        status = INCIDENT_APPROVED_SRM if approve else INCIDENT_REJECTED_SRM
+        with connect_db() as conn:
+            incident = conn.execute(
+                """
+                UPDATE cancellation_incidents
+                SET status = ?, srm_id = ?, srm_note = ?, resolved_at = ?, updated_at = ?
+                WHERE id = ? AND status = ?
+                RETURNING broker_id
+                """,
+                (status, user["id"], note, now_iso, now_iso, incident_id, INCIDENT_ESCALATED),
+            ).fetchone()
+            if not incident:
+                self._send_json(HTTPStatus.NOT_FOUND, {"ok": False, "error": "Escalation not found"})
+                return
+
+            flag = None
+            if not approve:
+                flag = apply_flag(
+                    conn,
+                    incident["broker_id"],
+                    incident_id,
+                    "Emergency cancellation rejected by SRM",
+                    now_dt,
                 )
 
-                flag = None
-                if not approve:
-                    flag = apply_flag(
-                        conn,
-                        incident["broker_id"],
-                        incident_id,
-                        "Emergency cancellation rejected by SRM",
-                    )
+            conn.commit()
 
-                conn.commit()
+        self._send_json(HTTPStatus.OK, {"ok": True, "flag": flag})
 
-            self._send_json(HTTPStatus.OK, {"ok": True, "flag": flag})
+    def _get_flags(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        broker_id = int(query.get("broker_id") or 0)
+        if user["role"] == ROLE_BROKER:
+            broker_id = user["id"]
+        if user["role"] == ROLE_RM and broker_id and broker_id not in self._assigned_broker_ids(user["id"]):
+            self._forbidden()
             return
+        if not broker_id:
+            broker_id = user["id"]
 
-        if method == "GET" and path == "/api/flags":
-            broker_id = int(query.get("broker_id") or 0)
-            with connect_db() as conn:
-                if user["role"] == ROLE_BROKER:
-                    broker_id = user["id"]
-                if user["role"] == ROLE_RM and broker_id and broker_id not in self._assigned_broker_ids(user["id"]):
-                    self._forbidden()
-                    return
-                if not broker_id:
-                    broker_id = user["id"]
+        with connect_db_readonly() as conn:
+            rows = conn.execute(
+                "SELECT * FROM broker_flags WHERE broker_id = ? ORDER BY created_at DESC",
+                (broker_id,),
+            )
+            self._send_json_items(rows)
 
-                rows = conn.execute(
-                    "SELECT * FROM broker_flags WHERE broker_id = ? ORDER BY created_at DESC",
-                    (broker_id,),
-                ).fetchall()
-            self._send_json(HTTPStatus.OK, {"ok": True, "items": [dict(r) for r in rows]})
+    def _get_leads(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        with connect_db_readonly() as conn:
+            rows = conn.execute(
+                """
+                SELECT l.*, c.name AS customer_name, c.phone_norm
+                FROM leads l
+                JOIN customers c ON c.id = l.customer_id
+                ORDER BY l.last_synced_at DESC
+                LIMIT 200
+                """
+            )
+            self._send_json_items(rows)
+
+    def _post_leads_import_now(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        job_id = submit_lead_import()
+        self._send_json(HTTPStatus.ACCEPTED, {"ok": True, "job_id": job_id, "status": "queued"})
+
+    def _get_leads_import_status(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        job = lead_import_status(query.get("job_id", ""))
+        if job is None:
+            self._send_json(HTTPStatus.NOT_FOUND, {"ok": False, "error": "Import job not found"})
             return
+        self._send_json(HTTPStatus.OK, {"ok": True, **job})
 
-        if method == "GET" and path == "/api/leads":
-            with connect_db() as conn:
-                rows = conn.execute(
-                    """
-                    SELECT l.*, c.name AS customer_name, c.phone_norm
-                    FROM leads l
-                    JOIN customers c ON c.id = l.customer_id
-                    ORDER BY l.last_synced_at DESC
-                    LIMIT 200
-                    """
-                ).fetchall()
-            self._send_json(HTTPStatus.OK, {"ok": True, "items": [dict(r) for r in rows]})
+    def _get_integrations_whatsapp_messages(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        if not require_role(user, [ROLE_RM, ROLE_SRM]):
+            self._forbidden()
             return
+        with connect_db_readonly() as conn:
+            rows = conn.execute(
+                """
+                SELECT *
+                FROM whatsapp_messages
+                ORDER BY created_at DESC
+                LIMIT 200
+                """
+            )
+            self._send_json_items(rows)
 
-        if method == "POST" and path == "/api/leads/import-now":
-            result = import_leads_from_csv()
-            self._send_json(HTTPStatus.OK, {"ok": True, "result": result})
+    def _post_integrations_whatsapp_send_test(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        if not require_role(user, [ROLE_RM, ROLE_SRM]):
+            self._forbidden()
             return
+        data = parse_request_body(self)
+        to_phone = normalize_phone(data.get("to_phone"))
+        template_name = (data.get("template_name") or "customer_help").strip()
+        context = data.get("context") or {}
+        related_visit_id = int(data.get("related_visit_id") or 0) or None
+        if not to_phone:
+            self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "to_phone is required"})
+            return
+        with connect_db() as conn:
+            result = send_whatsapp_template(
+                conn,
+                to_phone=to_phone,
+                template_name=template_name,
+                context=context if isinstance(context, dict) else {},
+                related_visit_id=related_visit_id,
+                source="manual_rm_send",
+                created_at=now_iso,
+            )
+            conn.commit()
+        self._send_json(HTTPStatus.OK, {"ok": True, "result": result})
 
-        if method == "GET" and path == "/api/integrations/whatsapp/messages":
-            if not require_role(user, [ROLE_RM, ROLE_SRM]):
-                self._forbidden()
-                return
-            with connect_db() as conn:
-                rows = conn.execute(
-                    """
-                    SELECT *
-                    FROM whatsapp_messages
-                    ORDER BY created_at DESC
-                    LIMIT 200
-                    """
-                ).fetchall()
-            self._send_json(HTTPStatus.OK, {"ok": True, "items": [dict(r) for r in rows]})
+    def _get_reports_funnel(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        if not require_role(user, [ROLE_RM, ROLE_SRM]):
+            self._forbidden()
             return
+        with connect_db_readonly() as conn:
+            report = build_funnel_report(conn)
+        self._send_json(HTTPStatus.OK, {"ok": True, "report": report})
 
-        if method == "POST" and path == "/api/integrations/whatsapp/send-test":
-            if not require_role(user, [ROLE_RM, ROLE_SRM]):
-                self._forbidden()
-                return
-            data = parse_request_body(self)
-            to_phone = normalize_phone(data.get("to_phone"))
-            template_name = (data.get("template_name") or "customer_help").strip()
-            context = data.get("context") or {}
-            related_visit_id = int(data.get("related_visit_id") or 0) or None
-            if not to_phone:
-                self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "to_phone is required"})
-                return
-            with connect_db() as conn:
-                result = send_whatsapp_template(
-                    conn,
-                    to_phone=to_phone,
-                    template_name=template_name,
-                    context=context if isinstance(context, dict) else {},
-                    related_visit_id=related_visit_id,
-                    source="manual_rm_send",
-                )
-                conn.commit()
-            self._send_json(HTTPStatus.OK, {"ok": True, "result": result})
+    def _get_reports_broker_reliability(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        if not require_role(user, [ROLE_RM, ROLE_SRM]):
+            self._forbidden()
             return
+        with connect_db_readonly() as conn:
+            items = build_broker_reliability_report(conn)
+        self._send_json(HTTPStatus.OK, {"ok": True, "items": items})
 
-        if method == "GET" and path == "/api/reports/funnel":
-            if not require_role(user, [ROLE_RM, ROLE_SRM]):
-                self._forbidden()
-                return
-            with connect_db() as conn:
-                report = build_funnel_report(conn)
-            self._send_json(HTTPStatus.OK, {"ok": True, "report": report})
+    def _get_reports_visit_counts(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        if not require_role(user, [ROLE_RM, ROLE_SRM, ROLE_BROKER]):
+            self._forbidden()
             return
 
-        if method == "GET" and path == "/api/reports/broker-reliability":
-            if not require_role(user, [ROLE_RM, ROLE_SRM]):
-                self._forbidden()
-                return
-            with connect_db() as conn:
-                items = build_broker_reliability_report(conn)
-            self._send_json(HTTPStatus.OK, {"ok": True, "items": items})
+        with connect_db_readonly() as conn:
+            rows = conn.execute(
+                """
+                SELECT
+                    u.id AS broker_id,
+                    u.name AS broker_name,
+                    COUNT(v.id) FILTER (WHERE v.is_unique_visit = 1) AS unique_visits,
+                    COUNT(v.id) FILTER (WHERE v.is_unique_visit = 0) AS non_unique_visits,
+                    COUNT(v.id) AS total_completed
+                FROM users u
+                LEFT JOIN visits v ON v.broker_id = u.id AND v.status = :status
+                WHERE u.role = :role
+                GROUP BY u.id, u.name
+                ORDER BY u.name ASC
+                """,
+                {"status": VISIT_STATUS_COMPLETED, "role": ROLE_BROKER},
+            )
+            self._send_json_items(rows)
+
+    def _get_reports_export_csv(self, user: sqlite3.Row | None, query: dict, now_dt: datetime, now_iso: str) -> None:
+        if not require_role(user, [ROLE_RM, ROLE_SRM]):
+            self._forbidden()
             return
 
-        if method == "GET" and path == "/api/reports/visit-counts":
-            with connect_db() as conn:
+        export_type = (query.get("type") or "visit_counts").strip().lower()
+        filename = f"{export_type}_{now_dt.strftime('%Y%m%d_%H%M%S')}.csv"
+        with connect_db_readonly() as conn:
+            if export_type == "visit_counts":
                 rows = conn.execute(
                     """
                     SELECT
-                        u.id AS broker_id,
                         u.name AS broker_name,
-                        SUM(CASE WHEN v.status = ? AND v.is_unique_visit = 1 THEN 1 ELSE 0 END) AS unique_visits,
-                        SUM(CASE WHEN v.status = ? AND v.is_unique_visit = 0 THEN 1 ELSE 0 END) AS non_unique_visits,
-                        SUM(CASE WHEN v.status = ? THEN 1 ELSE 0 END) AS total_completed
+                        COUNT(v.id) FILTER (WHERE v.is_unique_visit = 1) AS unique_visits,
+                        COUNT(v.id) FILTER (WHERE v.is_unique_visit = 0) AS non_unique_visits,
+                        COUNT(v.id) AS total_completed
                     FROM users u
-                    LEFT JOIN visits v ON v.broker_id = u.id
-                    WHERE u.role = ?
+                    LEFT JOIN visits v ON v.broker_id = u.id AND v.status = :status
+                    WHERE u.role = :role
                     GROUP BY u.id, u.name
                     ORDER BY u.name ASC
                     """,
-                    (VISIT_STATUS_COMPLETED, VISIT_STATUS_COMPLETED, VISIT_STATUS_COMPLETED, ROLE_BROKER),
-                ).fetchall()
-            self._send_json(HTTPStatus.OK, {"ok": True, "items": [dict(r) for r in rows]})
-            return
-
-        if method == "GET" and path == "/api/reports/export.csv":
-            if not require_role(user, [ROLE_RM, ROLE_SRM]):
-                self._forbidden()
+                    {"status": VISIT_STATUS_COMPLETED, "role": ROLE_BROKER},
+                )
+                self._send_csv(
+                    filename,
+                    ["broker_name", "unique_visits", "non_unique_visits", "total_completed"],
+                    rows,
+                )
+            elif export_type == "funnel":
+                report = build_funnel_report(conn)
+                self._send_csv(
+                    filename,
+                    ["metric", "value"],
+                    report.items(),
+                )
+            elif export_type == "broker_reliability":
+                items = build_broker_reliability_report(conn)
+                self._send_csv(
+                    filename,
+                    [
+                        "broker_id",
+                        "broker_name",
+                        "city",
+                        "active",
+                        "total_visits",
+                        "completed_visits",
+                        "completion_rate_pct",
+                        "broker_cancelled_visits",
+                        "late_cancel_incidents",
+                        "active_flags",
+                    ],
+                    (
+                        [
+                            item["broker_id"],
+                            item["broker_name"],
+                            item["city"],
+                            item["active"],
+                            item["total_visits"],
+                            item["completed_visits"],
+                            item["completion_rate_pct"],
+                            item["broker_cancelled_visits"],
+                            item["late_cancel_incidents"],
+                            item["active_flags"],
+                        ]
+                        for item in items
+                    ),
+                )
+            elif export_type == "whatsapp_messages":
+                rows = conn.execute(
+                    """
+                    SELECT
+                        id, direction, source, to_phone, from_phone, template_name,
+                        message_text, status, related_visit_id, created_at
+                    FROM whatsapp_messages
+                    ORDER BY created_at DESC
+                    LIMIT 1000
+                    """
+                )
+                self._send_csv(
+                    filename,
+                    [
+                        "id",
+                        "direction",
+                        "source",
+                        "to_phone",
+                        "from_phone",
+                        "template_name",
+                        "message_text",
+                        "status",
+                        "related_visit_id",
+                        "created_at",
+                    ],
+                    rows,
+                )
+            elif export_type == "visits":
+                rows = conn.execute(
+                    """
+                    SELECT
+                        v.id, v.status, v.cancelled_by, v.cancellation_reason,
+                        v.start_at, v.end_at, v.is_unique_visit, v.completion_mode,
+                        c.name AS customer_name, c.phone_norm,
+                        p.title AS property_title,
+                        b.name AS broker_name
+                    FROM visits v
+                    JOIN customers c ON c.id = v.customer_id
+                    JOIN properties p ON p.id = v.property_id
+                    JOIN users b ON b.id = v.broker_id
+                    ORDER BY v.start_at DESC
+                    LIMIT 2000
+                    """
+                )
+                self._send_csv(
+                    filename,
+                    [
+                        "visit_id",
+                        "status",
+                        "cancelled_by",
+                        "cancellation_reason",
+                        "start_at",
+                        "end_at",
+                        "is_unique_visit",
+                        "completion_mode",
+                        "customer_name",
+                        "customer_phone",
+                        "property_title",
+                        "broker_name",
+                    ],
+                    rows,
+                )
+            else:
+                self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "Unknown export type"})
                 return
 
-            export_type = (query.get("type") or "visit_counts").strip().lower()
-            with connect_db() as conn:
-                if export_type == "visit_counts":
-                    rows = conn.execute(
-                        """
-                        SELECT
-                            u.name AS broker_name,
-                            SUM(CASE WHEN v.status = ? AND v.is_unique_visit = 1 THEN 1 ELSE 0 END) AS unique_visits,
-                            SUM(CASE WHEN v.status = ? AND v.is_unique_visit = 0 THEN 1 ELSE 0 END) AS non_unique_visits,
-                            SUM(CASE WHEN v.status = ? THEN 1 ELSE 0 END) AS total_completed
-                        FROM users u
-                        LEFT JOIN visits v ON v.broker_id = u.id
-                        WHERE u.role = ?
-                        GROUP BY u.id, u.name
-                        ORDER BY u.name ASC
-                        """,
-                        (VISIT_STATUS_COMPLETED, VISIT_STATUS_COMPLETED, VISIT_STATUS_COMPLETED, ROLE_BROKER),
-                    ).fetchall()
-                    csv_payload = csv_text(
-                        ["broker_name", "unique_visits", "non_unique_visits", "total_completed"],
-                        [[r["broker_name"], r["unique_visits"], r["non_unique_visits"], r["total_completed"]] for r in rows],
-                    )
-                elif export_type == "funnel":
-                    report = build_funnel_report(conn)
-                    csv_payload = csv_text(
-                        ["metric", "value"],
-                        [[k, v] for k, v in report.items()],
-                    )
-                elif export_type == "broker_reliability":
-                    items = build_broker_reliability_report(conn)
-                    csv_payload = csv_text(
-                        [
-                            "broker_id",
-                            "broker_name",
-                            "city",
-                            "active",
-                            "total_visits",
-                            "completed_visits",
-                            "completion_rate_pct",
-                            "broker_cancelled_visits",
-                            "late_cancel_incidents",
-                            "active_flags",
-                        ],
-                        [
-                            [
-                                item["broker_id"],
-                                item["broker_name"],
-                                item["city"],
-                                item["active"],
-                                item["total_visits"],
-                                item["completed_visits"],
-                                item["completion_rate_pct"],
-                                item["broker_cancelled_visits"],
-                                item["late_cancel_incidents"],
-                                item["active_flags"],
-                            ]
-                            for item in items
-                        ],
-                    )
-                elif export_type == "whatsapp_messages":
-                    rows = conn.execute(
-                        """
-                        SELECT
-                            id, direction, source, to_phone, from_phone, template_name,
-                            message_text, status, related_visit_id, created_at
-                        FROM whatsapp_messages
-                        ORDER BY created_at DESC
-                        LIMIT 1000
-                        """
-                    ).fetchall()
-                    csv_payload = csv_text(
-                        [
-                            "id",
-                            "direction",
-                            "source",
-                            "to_phone",
-                            "from_phone",
-                            "template_name",
-                            "message_text",
-                            "status",
-                            "related_visit_id",
-                            "created_at",
-                        ],
-                        [
-                            [
-                                row["id"],
-                                row["direction"],
-                                row["source"],
-                                row["to_phone"],
-                                row["from_phone"],
-                                row["template_name"],
-                                row["message_text"],
-                                row["status"],
-                                row["related_visit_id"],
-                                row["created_at"],
-                            ]
-                            for row in rows
-                        ],
-                    )
-                elif export_type == "visits":
-                    rows = conn.execute(
-                        """
-                        SELECT
-                            v.id, v.status, v.cancelled_by, v.cancellation_reason,
-                            v.start_at, v.end_at, v.is_unique_visit, v.completion_mode,
-                            c.name AS customer_name, c.phone_norm,
-                            p.title AS property_title,
-                            b.name AS broker_name
-                        FROM visits v
-                        JOIN customers c ON c.id = v.customer_id
-                        JOIN properties p ON p.id = v.property_id
-                        JOIN users b ON b.id = v.broker_id
-                        ORDER BY v.start_at DESC
-                        LIMIT 2000
-                        """
-                    ).fetchall()
-                    csv_payload = csv_text(
-                        [
-                            "visit_id",
-                            "status",
-                            "cancelled_by",
-                            "cancellation_reason",
-                            "start_at",
-                            "end_at",
-                            "is_unique_visit",
-                            "completion_mode",
-                            "customer_name",
-                            "customer_phone",
-                            "property_title",
-                            "broker_name",
-                        ],
-                        [
-                            [
-                                row["id"],
-                                row["status"],
-                                row["cancelled_by"],
-                                row["cancellation_reason"],
-                                row["start_at"],
-                                row["end_at"],
-                                row["is_unique_visit"],
-                                row["completion_mode"],
-                                row["customer_name"],
-                                row["phone_norm"],
-                                row["property_title"],
-                                row["broker_name"],
-                            ]
-                            for row in rows
-                        ],
-                    )
-                else:
-                    self._send_json(HTTPStatus.BAD_REQUEST, {"ok": False, "error": "Unknown export type"})
-                    return
+    def _assigned_brokers(self, rm_id: int) -> tuple[tuple[int, ...], str]:
+        cached = _assigned_brokers_cache.get(rm_id)
+        if cached is not None and time.monotonic() - cached[0] < ASSIGNED_BROKERS_CACHE_TTL_SECONDS:
+            return cached[1], cached[2]
+        broker_ids = tuple(
+            broker_id
+            for (broker_id,) in connect_db_readonly().execute(
+                "SELECT broker_id FROM rm_assignments WHERE rm_id = ?",
+                (rm_id,),
+            )
+        )
+        broker_ids_json = PAYLOAD_JSON_ENCODER.encode(broker_ids)
+        with _assigned_brokers_cache_lock:
+            _assigned_brokers_cache[rm_id] = (time.monotonic(), broker_ids, broker_ids_json)
+        return broker_ids, broker_ids_json
+
+    def _assigned_broker_ids(self, rm_id: int) -> tuple[int, ...]:
+        return self._assigned_brokers(rm_id)[0]
+
+    PUBLIC_API_ROUTES = {
+        ("GET", "/api/health"): _get_health,
+        ("GET", "/api/scheduling/duration"): _get_scheduling_duration,
+        ("GET", "/api/customer/visits"): _get_customer_visits,
+        ("POST", "/api/customer/visits/cancel"): _post_customer_visits_cancel,
+        ("POST", "/api/customer/visits/reschedule"): _post_customer_visits_reschedule,
+        ("POST", "/api/integrations/whatsapp/webhook"): _post_integrations_whatsapp_webhook,
+        ("POST", "/api/auth/login"): _post_auth_login,
+    }
 
-            filename = f"{export_type}_{now_local().strftime('%Y%m%d_%H%M%S')}.csv"
-            self._send_csv(filename, csv_payload)
-            return
+    API_ROUTES = {
+        ("GET", "/api/auth/me"): _get_auth_me,
+        ("GET", "/api/dashboard"): _get_dashboard,
+        ("GET", "/api/inventory"): _get_inventory,
+        ("GET", "/api/inventory/item"): _get_inventory_item,
+        ("POST", "/api/inventory"): _post_inventory,
+        ("POST", "/api/inventory/remove"): _post_inventory_remove,
+        ("GET", "/api/rm/duplicate-queue"): _get_rm_duplicate_queue,
+        ("POST", "/api/rm/duplicate-review"): _post_rm_duplicate_review,
+        ("GET", "/api/slots"): _get_slots,
+        ("POST", "/api/slots/add"): _post_slots_add,
+        ("POST", "/api/slots/cancel"): _post_slots_cancel,
+        ("GET", "/api/visits"): _get_visits,
+        ("POST", "/api/visits/book"): _post_visits_book,
+        ("POST", "/api/visits/send-otp"): _post_visits_send_otp,
+        ("POST", "/api/visits/complete"): _post_visits_complete,
+        ("GET", "/api/rm/emergency-queue"): _get_rm_emergency_queue,
+        ("POST", "/api/rm/emergency-review"): _post_rm_emergency_review,
+        ("GET", "/api/srm/escalations"): _get_srm_escalations,
+        ("POST", "/api/srm/escalation-review"): _post_srm_escalation_review,
+        ("GET", "/api/flags"): _get_flags,
+        ("GET", "/api/leads"): _get_leads,
+        ("POST", "/api/leads/import-now"): _post_leads_import_now,
+        ("GET", "/api/leads/import-status"): _get_leads_import_status,
+        ("GET", "/api/integrations/whatsapp/messages"): _get_integrations_whatsapp_messages,
+        ("POST", "/api/integrations/whatsapp/send-test"): _post_integrations_whatsapp_send_test,
+        ("GET", "/api/reports/funnel"): _get_reports_funnel,
+        ("GET", "/api/reports/broker-reliability"): _get_reports_broker_reliability,
+        ("GET", "/api/reports/visit-counts"): _get_reports_visit_counts,
+        ("GET", "/api/reports/export.csv"): _get_reports_export_csv,
+    }
 
-        self._send_json(HTTPStatus.NOT_FOUND, {"ok": False, "error": "Route not found"})
 
-    def _assigned_broker_ids(self, rm_id: int) -> list[int]:
-        with connect_db() as conn:
-            rows = conn.execute(
-                "SELECT broker_id FROM rm_assignments WHERE rm_id = ?",
-                (rm_id,),
-            ).fetchall()
-        return [row["broker_id"] for row in rows]
+class AppHTTPServer(ThreadingHTTPServer):
+    daemon_threads = False
+    request_queue_size = HTTP_LISTEN_BACKLOG
 
 
 def main() -> None:
     init_db()
-    import_leads_from_csv()
+    release_db()
+    db_pool.prewarm()
+    db_reader_pool.prewarm()
 
     stop_event = threading.Event()
     sync_thread = LeadSyncThread(stop_event)
     sync_thread.start()
+    maintenance_thread = MaintenanceThread(stop_event)
+    maintenance_thread.start()
 
     host = os.getenv("HOST", "127.0.0.1")
     port = int(os.getenv("PORT", "8080"))
-    server = ThreadingHTTPServer((host, port), AppHandler)
+    server = AppHTTPServer((host, port), AppHandler)
     ui_host = "127.0.0.1" if host in ("0.0.0.0", "::") else host
 
-    print("Proptech MVP running")
-    print(f"URL: http://{ui_host}:{port}")
-    print(f"Listening on {host}:{port}")
-    print("Demo users:")
-    print("- broker.jaipur@example.com / broker123")
-    print("- broker.nagpur@example.com / broker123")
-    print("- rm.jaipur@example.com / rm123")
-    print("- rm.nagpur@example.com / rm123")
-    print("- srm.ops@example.com / srm123")
+    print(STARTUP_BANNER.format(ui_host=ui_host, host=host, port=port), flush=True)
 
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown, daemon=True).start())
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         pass
     finally:
         stop_event.set()
+        sync_thread.join()
+        maintenance_thread.join()
         server.server_close()
+        _lead_import_executor.shutdown(wait=True)
+        connect_db().execute("PRAGMA wal_checkpoint(TRUNCATE);")
+        release_db()
+        db_pool.close()
+        db_reader_pool.close()
 
 
 if __name__ == "__main__":